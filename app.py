@@ -1,14 +1,33 @@
+# eventlet and gevent have to patch the standard library before anything else is imported.
+# Threads are left alone, capture, recording and motion detection stay real threads running in parallel
+from os import getenv
+from dotenv import load_dotenv
+load_dotenv()
+# Same default as config.ASYNC_MODE, Flask-SocketIO is never left to pick a green mode by itself
+ASYNC_MODE = getenv('ASYNC_MODE', 'threading').lower()
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch(thread=False)
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all(thread=False)
+
 from flask import Response, jsonify, send_from_directory, request
 from config import app
 from options import options
-from utils.camera import cam_utils
-from utils.socket import socketio
+from utils.camera import cam_utils, RecordingsType, log, start_services
+from utils.socket import socketio, events, run_blocking
+from utils.stream import MJPEG_MIMETYPE
+from utils.live import HLS_PLAYLIST, HLS_MIMETYPES
+from config import MAX_STREAMS, LIVE_HLS_ENABLED, LIVE_HLS_DIR, LIVE_HLS_SEGMENT_SECONDS, LIVE_HLS_WINDOW
+from utils.metrics import metrics
 from utils import *
-import csv
 import os
+import re
+from datetime import timedelta
 from flask_cors import cross_origin
-from moviepy.editor import VideoFileClip
-import json
+from utils.recordings_index import recordings_index, summary as recording_summary
+from utils.activitylog import activity_log
 
 @app.route('/')
 @app.route('/api')
@@ -18,103 +37,173 @@ def index():
 @app.route('/feed')
 @app.route('/api/feed')
 def feed():
-    return Response(cam_utils.gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(cam_utils.gen_frames(), mimetype=MJPEG_MIMETYPE)
+
+@app.route('/snapshot.jpg')
+@app.route('/api/snapshot.jpg')
+def snapshot():
+    # The newest frame of the capture loop, ?width= scales it down and ?quality= is the JPEG quality (1-100)
+    try:
+        width = request.args.get('width', type=int)
+        quality = request.args.get('quality', type=int)
+        if (width is not None and width < 16) or (quality is not None and not 1 <= quality <= 100):
+            raise ValueError("width must be at least 16 and quality between 1 and 100")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    image = cam_utils.snapshots.get(width, quality)
+    if not image:
+        return jsonify({"error": "No frame captured yet"}), 503
+    seq, jpg = image
+    response = Response(jpg, mimetype='image/jpeg')
+    # Unchanged until the next frame, pollers asking again for the same frame get a 304.
+    # Frame numbers start over when the server restarts, the nonce keeps old ETags from matching
+    response.set_etag(f"{cam_utils.snapshots.nonce}-{seq}-{width}-{quality}")
+    return response.make_conditional(request)
+
+@app.route('/api/live/<name>')
+def live(name):
+    # HLS alternative to /feed, one shared H.264 encoder instead of a JPEG per frame per viewer
+    if not LIVE_HLS_ENABLED:
+        return jsonify({"error": "Live stream disabled"}), 404
+    if name == HLS_PLAYLIST:
+        if not cam_utils.live.request():
+            response = jsonify({"error": "Live stream starting"})
+            response.headers['Retry-After'] = str(LIVE_HLS_SEGMENT_SECONDS)
+            return response, 503
+        response = send_from_directory(LIVE_HLS_DIR, name, mimetype=HLS_MIMETYPES['.m3u8'])
+        # The playlist changes with every segment
+        response.cache_control.no_cache = True
+        return response
+    file = cam_utils.live.path(name)
+    if not file or not os.path.exists(file):
+        return jsonify({"error": "Segment not found"}), 404
+    response = send_from_directory(LIVE_HLS_DIR, name, mimetype=HLS_MIMETYPES[os.path.splitext(name)[1]])
+    # Segment names are never reused, so they can be cached for as long as they are listed
+    response.cache_control.public = True
+    response.cache_control.max_age = LIVE_HLS_SEGMENT_SECONDS * LIVE_HLS_WINDOW
+    return response
 
 # The version of Flask on the Pi could be a little old to support
 # the newer @app decorator functions if installed with apt
 
+MAX_PAGE_SIZE = 500
+# Query arguments that ask for a page, others (e.g. cache busters) keep the plain list
+RECORDINGS_PAGE_ARGS = ('limit', 'cursor', 'type', 'from', 'to', 'sort')
+LOGS_PAGE_ARGS = ('limit', 'before', 'type')
+
+def recordings_page(format):
+    """
+    List recordings from the index. Without paging arguments the whole collection is returned as before,
+    otherwise ?limit=&cursor=&type=&from=&to=&sort=newest|oldest returns {"items": [...], "cursor": ...}
+    where cursor is passed back to get the next page and is null on the last page.
+    """
+    if not any(arg in request.args for arg in RECORDINGS_PAGE_ARGS):
+        return jsonify([format(row) for row in recordings_index.list()])
+
+    try:
+        limit = min(int(request.args.get('limit', 50)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        rec_type = request.args.get('type')
+        if rec_type and rec_type not in (t.value for t in RecordingsType):
+            raise ValueError(f"Unknown recording type '{rec_type}'")
+        since, until = request.args.get('from'), request.args.get('to')
+        since = since and iso_to_date(since).replace(tzinfo=None)
+        # A date without a time includes the whole day
+        until = until and iso_to_date(until).replace(tzinfo=None) + (timedelta(days=1) if len(until) == 10 else timedelta())
+        sort = request.args.get('sort', 'newest')
+        if sort not in ('newest', 'oldest'):
+            raise ValueError("sort must be 'newest' or 'oldest'")
+        rows, cursor = recordings_index.query(limit, request.args.get('cursor'), rec_type, since, until, sort == 'newest')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"items": [format(row) for row in rows], "cursor": cursor})
+
 # @app.get('/videos')
 @app.route('/videos')
 @app.route('/api/videos')
 def list_videos():
-    return jsonify(get_videos())
+    return recordings_page(video_info)
 
 # @app.delete('/videos/<name>')
 @app.route('/videos/delete/<name>', methods=['DELETE'])
 @app.route('/api/videos/delete/<name>', methods=['DELETE'])
 def del_video(name):
+    # Dropped from the transcode queue first, a finished transcode would bring it back
+    cam_utils.transcoder.cancel(os.path.basename(name))
+    # The recordings index (and recordings.json) is updated by delete_video
     result = delete_video(name)
-    # تحديث recordings.json بعد الحذف
-    json_path = os.path.join('frontend/public/recordings', 'recordings.json')
-    if os.path.exists(json_path):
-        try:
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            # احذف الفيديو من القائمة إذا كان موجودًا
-            data = [rec for rec in data if rec.get('name') != name]
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Failed to update recordings.json: {e}")
     return jsonify({ "message": result })
 
 @app.route('/recordings/')
+@app.route('/api/recordings/')
 def get_recordings():
-    recordings_path = os.path.join(app.static_folder, 'recordings')
-    json_path = os.path.join(recordings_path, 'recordings.json')
     try:
-        files = os.listdir(recordings_path)
-        videos = []
-        for f in files:
-            if f.endswith(".mp4"):
-                file_path = os.path.join(recordings_path, f)
-                size = os.path.getsize(file_path)
-                # Try to get real duration
-                try:
-                    clip = VideoFileClip(file_path)
-                    duration = f"{int(clip.duration)}s"
-                    clip.close()
-                except Exception:
-                    duration = "N/A"
-                videos.append({
-                    "name": f,
-                    "url": f"/recordings/{f}",
-                    "date": f.split("_")[0],
-                    "size": f"{size // 1_000_000} MB",
-                    "duration": duration
-                })
-        
-        # Update recordings.json with the latest data
-        try:
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(videos, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Failed to update recordings.json: {e}")
-            
-        return jsonify(videos)
+        return recordings_page(recording_summary)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/recordings/thumbnails/<filename>')
+@app.route('/api/recordings/thumbnails/<filename>')
+def serve_thumbnail(filename):
+    # Thumbnails are created in the background, this only serves existing files.
+    # conditional=True answers If-None-Match with 304 using the strong ETag of the file
+    return send_from_directory(thumbnails.thumbnails_dir, filename, mimetype='image/jpeg', conditional=True)
+
 @app.route('/recordings/<filename>')
 @app.route('/api/recordings/<filename>')
 def serve_recording(filename):
     recordings_path = os.path.join(app.static_folder, 'recordings')
     try:
-        return send_from_directory(recordings_path, filename, mimetype='video/mp4')
+        # conditional=True answers Range requests with 206 Partial Content, so seeking only fetches
+        # what's needed, and If-None-Match/If-Modified-Since with 304 using the ETag and Last-Modified
+        return send_from_directory(recordings_path, filename, conditional=True,
+                                   mimetype='video/mp4' if filename.endswith('.mp4') else None)
     except Exception as e:
         return jsonify({"error": str(e)}), 404
 
+@app.route('/metrics')
+@app.route('/api/metrics')
+def get_metrics():
+    # Prometheus text format, per stage latency histograms of the capture pipeline and gauges
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Catch-all route for React Router (except API/static)
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def catch_all(path):
     if path.startswith('api') or path.startswith('recordings') or path.startswith('static'):
-        return send_from_directory(app.static_folder, path)
+        return send_from_directory(app.static_folder, path, conditional=True)
     return app.send_static_file('index.html')
 
 @app.route('/<path:filename>')
 @app.route('/api/<path:filename>')
 def send_static(filename):
-    return send_from_directory(app.static_folder, filename)
+    return send_from_directory(app.static_folder, filename, conditional=True)
+
+# Built by Vite with a content hash in the name, e.g. /assets/index-C4jSnqLi.js
+HASHED_ASSET = re.compile(r'^/(api/)?assets/.+-[\w-]{8}\.(js|css|woff2?|png|svg)$')
 
 @app.after_request
 def add_header(response):
-    # Too much caching for a very lively dashboard with feed and frequent updates and logs
-    # Disabling all caching to make sure users always get the latest data
-    response.cache_control.no_cache = True
-    response.cache_control.no_store = True
-    response.cache_control.must_revalidate = True
-    response.cache_control.max_age = 0
+    if request.path.startswith('/api/live/'):
+        # The live stream sets its own caching
+        return response
+
+    if HASHED_ASSET.match(request.path) and response.status_code in (200, 206, 304):
+        # A new build comes with new names, so these never change
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    elif response.headers.get('ETag') or response.headers.get('Last-Modified'):
+        # Files (recordings, thumbnails, index.html...) are kept by the browser but revalidated
+        # every time, which is a cheap 304 as long as they are unchanged
+        response.cache_control.no_cache = True
+    else:
+        # Live API responses change all the time, don't store them anywhere
+        response.cache_control.no_cache = True
+        response.cache_control.no_store = True
+        response.cache_control.must_revalidate = True
+        response.cache_control.max_age = 0
 
     return response
 
@@ -129,42 +218,48 @@ if len(sys.argv) > 1 and sys.argv[1] == 'autostart':
 
 def notify(title, key=None):
     # Send a notification to the frontend
-    notify_sock(title, key, socketio)
+    notify_sock(title, key, events)
 
-# Link camera events to appropriate socket events
-cam_utils.inform = lambda event, data=None: socketio.emit(event, data)
+# Link camera events to appropriate socket events, queued so the camera threads never wait for clients
+cam_utils.inform = events.emit
 cam_utils.notify = notify
+# Transcoding and thumbnails report to the dashboard, so they start once the events above are linked
+start_services()
+# Feed generators run in green threads with eventlet/gevent, they must wait for frames cooperatively
+cam_utils.stream_sleep = socketio.sleep if socketio.async_mode != 'threading' else None
 
 @app.route('/logs')
 @cross_origin()
 def get_logs():
-    logs_path = os.path.join(app.static_folder, 'activitylogs.csv')
-    logs = []
-    if os.path.exists(logs_path):
-        with open(logs_path, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                logs.append({
-                    "timestamp": row.get("Timestamp"),
-                    "shortMessage": row.get("Short Message"),
-                    "longMessage": row.get("Long Message"),
-                    "logType": row.get("Log Type")
-                })
-    return jsonify(logs[::-1])  # Most recent first
+    """
+    Activity logs, most recent first. Without paging arguments all of them are returned as before,
+    otherwise ?limit=&before=&type= returns {"items": [...], "before": ...} where before is passed
+    back to get the next (older) page and is null on the last page.
+    """
+    if not any(arg in request.args for arg in LOGS_PAGE_ARGS):
+        return jsonify(activity_log.read())
+    try:
+        limit = min(int(request.args.get('limit', 50)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Timestamps are stored like str(datetime), accept ISO ones too
+    before = request.args.get('before', '').replace('T', ' ') or None
+    logs = activity_log.read(limit, before, request.args.get('type'))
+    return jsonify({"items": logs, "before": logs[-1]["timestamp"] if len(logs) == limit else None})
 
 @app.route('/logs/clear', methods=['POST'])
 @cross_origin()
 def clear_logs():
-    logs_path = os.path.join(app.static_folder, 'activitylogs.csv')
-    with open(logs_path, 'w') as f:
-        f.write("Timestamp,Short Message,Long Message,Log Type\n")
+    activity_log.clear()
     return jsonify({"status": "cleared"})
 
 @app.route('/api/videos/start', methods=['POST'])
 @cross_origin()
 def start_manual_recording():
     try:
-        cam_utils.start_recording()
+        run_blocking(cam_utils.start_recording)
         return jsonify({"status": "started"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -173,7 +268,7 @@ def start_manual_recording():
 @cross_origin()
 def stop_manual_recording():
     try:
-        cam_utils.stop_recording()
+        run_blocking(cam_utils.stop_recording)
         return jsonify({"status": "stopped"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -188,4 +283,5 @@ def after_request(response):
 
 if __name__ == '__main__':
     # Run the app with socketio support
+    log.info(f"Starting web server in {socketio.async_mode} mode, at most {MAX_STREAMS or 'unlimited'} full rate feed streams")
     socketio.run(app, '0.0.0.0', 5000)
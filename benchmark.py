@@ -0,0 +1,270 @@
+"""
+Offline benchmark of the capture pipeline.
+
+Drives the Camera from a video file instead of a camera: the background capture loop with
+a privacy zone, motion detection, JPEG encoding for feed viewers and a manual recording,
+at several resolutions. Reports the frame rate, latency percentiles per stage, memory and
+CPU use per core, and writes them to a JSON file that can be compared between commits.
+
+    python benchmark.py --resolutions 640x480,1280x720,1920x1080 --output bench.json
+    python benchmark.py --source clip.mp4 --compare bench.json
+
+Everything runs in a temporary directory, so existing recordings, logs and options are left alone.
+Without --source a synthetic clip with moving shapes is generated for each resolution.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import cv2
+import numpy as np
+
+from time import sleep, monotonic
+from threading import Thread, Event
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def synthetic_source(filename, width, height, fps=20, seconds=10):
+    """A clip with a few moving shapes on a noisy background, so motion detection has something to do"""
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    rng = np.random.default_rng(0)
+    background = rng.integers(60, 120, (height, width, 3), dtype=np.uint8)
+    for i in range(fps * seconds):
+        frame = background.copy()
+        x = int((i / (fps * seconds)) * width)
+        cv2.rectangle(frame, (x, height // 3), (x + width // 8, height // 3 + height // 6), (40, 200, 40), -1)
+        cv2.circle(frame, (width // 2, int(height / 2 + height / 4 * np.sin(i / 10))), height // 12, (200, 60, 60), -1)
+        writer.write(frame)
+    writer.release()
+    return filename
+
+
+def scaled_source(source, filename, width, height, max_frames=600):
+    """Copy of a recorded clip at another resolution, as OpenCV can't resize video files while reading"""
+    cap = cv2.VideoCapture(source)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 20
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for _ in range(max_frames):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        writer.write(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA))
+    cap.release()
+    writer.release()
+    return filename
+
+
+def cpu_times():
+    """(busy, total) jiffies of each core from /proc/stat, empty where that's not available"""
+    try:
+        with open("/proc/stat") as f:
+            lines = [line.split() for line in f if line.startswith("cpu") and not line.startswith("cpu ")]
+    except OSError:
+        return []
+    times = []
+    for _, *values in lines:
+        values = [int(v) for v in values]
+        idle = values[3] + (values[4] if len(values) > 4 else 0)
+        times.append((sum(values) - idle, sum(values)))
+    return times
+
+
+def cpu_percent_per_core(before, after):
+    return [
+        round(100 * (busy - busy0) / (total - total0), 1) if total > total0 else 0
+        for (busy0, total0), (busy, total) in zip(before, after)
+    ]
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(("git", "rev-parse", "HEAD"), cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(cam, source, resolution, duration, viewers):
+    from options import options
+    from utils.metrics import metrics
+    from utils.camera import RecordingsType
+
+    # Switch the camera to the clip for this resolution, like a resolution change from the dashboard
+    cam.source = source
+    cam.set_resolution(*resolution)
+    published = None
+    while not published:
+        published = cam.frames.wait(cam.frames.seq, timeout=5)
+    cam.frames.release(published[1])
+
+    stop = Event()
+
+    def viewer():
+        seq = 0
+        while not stop.is_set():
+            encoded = cam.mjpeg.next_part(seq)
+            if encoded:
+                seq = encoded[0]
+
+    threads = [Thread(target=viewer, daemon=True) for _ in range(viewers)]
+    for thread in threads:
+        thread.start()
+
+    cam.start_recording(RecordingsType.MANUAL, notify=False)
+    # Let the pipeline settle before measuring
+    sleep(1)
+
+    metrics.reset()
+    cam.benchmark_motion_events = 0
+    seq, skipped = cam.frames.seq, cam.pacer.skipped
+    cpu_before, times_before, started = cpu_times(), os.times(), monotonic()
+
+    sleep(duration)
+
+    elapsed = monotonic() - started
+    times_after, cpu_after = os.times(), cpu_times()
+    frames = cam.frames.seq - seq
+    motion_events = cam.benchmark_motion_events
+    snapshot = metrics.snapshot()
+
+    stop.set()
+    cam.stop_recording(RecordingsType.MANUAL)
+    for thread in threads:
+        thread.join()
+
+    process_cpu = (times_after.user - times_before.user) + (times_after.system - times_before.system)
+    return {
+        "resolution": "x".join(map(str, resolution)),
+        "source": os.path.basename(source),
+        "duration": round(elapsed, 2),
+        "viewers": viewers,
+        "target_fps": options.framerate,
+        "frames": frames,
+        "fps": round(frames / elapsed, 2),
+        "skipped_frames": cam.pacer.skipped - skipped,
+        "motion_events": motion_events,
+        "stages": snapshot["stages"],
+        "rss_mb": rss_mb(),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "process_cpu_percent": round(100 * process_cpu / elapsed, 1),
+        "cpu_percent_per_core": cpu_percent_per_core(cpu_before, cpu_after),
+    }
+
+
+def compare(results, previous_file):
+    with open(previous_file) as f:
+        previous = {run["resolution"]: run for run in json.load(f)["results"]}
+
+    print(f"\nCompared to {previous_file}:")
+    for result in results:
+        before = previous.get(result["resolution"])
+        if not before:
+            continue
+        change = (result["fps"] - before["fps"]) / before["fps"] * 100 if before["fps"] else 0
+        print(f"  {result['resolution']}: {before['fps']} -> {result['fps']} fps ({change:+.1f}%)")
+        for stage, stats in result["stages"].items():
+            old = before["stages"].get(stage)
+            if old:
+                print(f"    {stage:<8} p95 {old['p95_ms']:.2f} -> {stats['p95_ms']:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="video file to play instead of a synthetic clip")
+    parser.add_argument("--resolutions", default="640x480,1280x720,1920x1080", help="comma separated WIDTHxHEIGHT list")
+    parser.add_argument("--duration", type=float, default=10, help="seconds measured per resolution")
+    parser.add_argument("--fps", type=int, default=0, help="target frame rate, 0 runs as fast as possible")
+    parser.add_argument("--viewers", type=int, default=1, help="number of simulated feed viewers")
+    parser.add_argument("--output", default="bench.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    resolutions = [parse_resolution(r) for r in args.resolutions.split(",")]
+    output = os.path.abspath(args.output)
+    previous = args.compare and os.path.abspath(args.compare)
+    source = args.source and os.path.abspath(args.source)
+
+    workdir = tempfile.mkdtemp(prefix="camera-benchmark-")
+    sources = []
+    for width, height in resolutions:
+        filename = os.path.join(workdir, f"source-{width}x{height}.mp4")
+        print(f"Preparing {width}x{height} source...")
+        sources.append(scaled_source(source, filename, width, height) if source else synthetic_source(filename, width, height))
+
+    # The camera modules set themselves up on import, point them at the clip and the temporary directory
+    os.environ["CAMERA_SOURCE"] = sources[0]
+    # Converting the recorded clips would take CPU away from the next run
+    os.environ["TRANSCODE_QUEUE_SIZE"] = "0"
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    from options import options
+    from utils.camera import cam_utils
+
+    cam_utils.inform = cam_utils.notify = lambda *args: None
+
+    # Motion is counted rather than recorded, the manual recording already measures the recorder
+    cam_utils.benchmark_motion_events = 0
+    def on_motion():
+        cam_utils.benchmark_motion_events += 1
+    cam_utils.motion.on_motion = on_motion
+
+    options.logging = False
+    options.framerate = args.fps or 10_000
+    options.motiondetection = True
+    options.shape = {"x": 10, "y": 10, "width": 30, "height": 30, "blur": 10, "hsva": {"h": 218, "s": 1, "v": 63, "a": 0.5}}
+    # Set directly so options.json is left alone, the camera is told about them itself
+    cam_utils.apply_options()
+
+    results = []
+    for source_file, resolution in zip(sources, resolutions):
+        print(f"Running {'x'.join(map(str, resolution))} for {args.duration}s...")
+        result = run(cam_utils, source_file, resolution, args.duration, args.viewers)
+        print(f"  {result['fps']} fps, {result['process_cpu_percent']}% CPU, {result['rss_mb']} MB RSS")
+        for stage, stats in result["stages"].items():
+            print(f"    {stage:<8} p50 {stats['p50_ms']:.2f} ms  p95 {stats['p95_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms")
+        results.append(result)
+
+    report = {
+        "commit": git_commit(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    previous and compare(results, previous)
+    shutil.rmtree(workdir, ignore_errors=True)
+    # The camera threads never return, no need to wait for them
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
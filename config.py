@@ -1,4 +1,5 @@
 from os import getenv, path, makedirs
+from tempfile import gettempdir
 from flask import Flask
 from flask_cors import CORS, cross_origin
 from dotenv import load_dotenv
@@ -14,6 +15,68 @@ recordings_dir = path.abspath("frontend/public/recordings")
 # Make sure recordings directory exists
 makedirs(recordings_dir, exist_ok=True)
 
+# Metadata of the recordings is indexed so listing them doesn't need to open every file
+recordings_index_file = path.join(recordings_dir, "recordings.db")
+# Static copy of the index used by the dashboard when the backend can't be reached
+recordings_json_file = path.join(recordings_dir, "recordings.json")
+
+# Thumbnail widths in pixels, the first size is the one shown by the dashboard
+THUMBNAIL_SIZES = {
+    "medium": int(getenv('THUMBNAIL_MEDIUM_WIDTH', 320)),
+    "small": int(getenv('THUMBNAIL_SMALL_WIDTH', 160)),
+}
+# Number of frames in the preview strip of each recording, 0 disables it
+THUMBNAIL_SPRITE_FRAMES = int(getenv('THUMBNAIL_SPRITE_FRAMES', 0))
+
+# Memory cap of the motion pre-roll buffer, it holds fewer seconds than configured at high resolutions
+PREROLL_MAX_BYTES = int(getenv('PREROLL_MAX_BYTES', 64 * 1024 * 1024))
+
+# Recordings are encoded to H.264 while recording by piping frames to ffmpeg ("ffmpeg"),
+# or written by OpenCV and transcoded afterwards ("opencv"), which is also the fallback
+RECORDING_BACKEND = getenv('RECORDING_BACKEND', 'ffmpeg').lower()
+# ffmpeg encoder, h264_v4l2m2m uses the hardware encoder of a Raspberry Pi
+RECORDING_ENCODER = getenv('RECORDING_ENCODER', 'libx264')
+# x264 preset, faster presets leave more CPU for capture at the cost of bigger files
+RECORDING_PRESET = getenv('RECORDING_PRESET', 'ultrafast')
+
+# Overlapping recordings are cut from one stream encoded in keyframe aligned chunks of this many seconds,
+# so a recording can start and end up to this much early or late
+RECORDING_CHUNK_SECONDS = float(getenv('RECORDING_CHUNK_SECONDS', 2))
+# Memory cap of the frames waiting to be written per recording, the oldest are dropped when storage can't keep up
+RECORDING_QUEUE_MAX_BYTES = int(getenv('RECORDING_QUEUE_MAX_BYTES', 32 * 1024 * 1024))
+
+# Live HLS stream at /api/live/index.m3u8, encoded once for all viewers while anyone is watching.
+# Segments are kept in memory (tmpfs) in a sliding window of LIVE_HLS_WINDOW segments
+LIVE_HLS_ENABLED = getenv('LIVE_HLS_ENABLED', '1') not in ('0', 'false', 'False')
+LIVE_HLS_DIR = getenv('LIVE_HLS_DIR', path.join("/dev/shm" if path.isdir("/dev/shm") else gettempdir(), "camera-live"))
+LIVE_HLS_FPS = int(getenv('LIVE_HLS_FPS', 15))
+LIVE_HLS_SEGMENT_SECONDS = int(getenv('LIVE_HLS_SEGMENT_SECONDS', 2))
+LIVE_HLS_WINDOW = int(getenv('LIVE_HLS_WINDOW', 6))
+
+# Motion analysis and live feed JPEG encoding run on threads of the server process ("threads"),
+# or in worker processes that get the frames through shared memory ("processes"), using more cores
+PIPELINE_MODE = getenv('PIPELINE_MODE', 'threads').lower()
+# Worker processes per stage, motion keeps one background model so it always has a single worker
+PIPELINE_JPEG_WORKERS = int(getenv('PIPELINE_JPEG_WORKERS', 2))
+PIPELINE_MOTION_WORKERS = 1
+# Frames in flight per worker, frames are skipped when all are busy
+PIPELINE_SLOTS_PER_WORKER = int(getenv('PIPELINE_SLOTS_PER_WORKER', 2))
+
+# Recordings OpenCV made are converted to H.264 in the background, unfinished jobs are kept
+# in this file so they are resumed after a restart
+transcode_queue_file = path.join(recordings_dir, "transcode-queue.json")
+TRANSCODE_WORKERS = int(getenv('TRANSCODE_WORKERS', 1))
+# Threads given to each ffmpeg transcode, leave some cores for live capture
+TRANSCODE_THREADS = int(getenv('TRANSCODE_THREADS', 2))
+# Nice value of the transcode workers, higher means lower priority than capture
+TRANSCODE_NICENESS = int(getenv('TRANSCODE_NICENESS', 10))
+TRANSCODE_QUEUE_SIZE = int(getenv('TRANSCODE_QUEUE_SIZE', 32))
+
+# Above this size the activity log is moved to activitylogs.csv.1, the line limit option is usually hit first
+LOG_MAX_BYTES = int(getenv('LOG_MAX_BYTES', 5 * 1024 * 1024))
+# New activity log entries are written to disk in batches at most this often
+LOG_FLUSH_SECONDS = float(getenv('LOG_FLUSH_SECONDS', 1))
+
 # Make sure activity logs file exists
 with open(log_file, 'a'):
     pass
@@ -22,6 +85,23 @@ with open(log_file, 'a'):
 # NOT_USING_PYCAMERA = getenv('NOT_USING_PYCAMERA', False)
 NOT_USING_PYCAMERA = True
 testing_environment = NOT_USING_PYCAMERA
+# Webcam index or path of a video file (looped) used instead of Picamera2, e.g. for benchmarks
+CAMERA_SOURCE = getenv('CAMERA_SOURCE', '0')
+CAMERA_SOURCE = int(CAMERA_SOURCE) if CAMERA_SOURCE.isdigit() else CAMERA_SOURCE
+
+# Server mode: eventlet or gevent serve many idle sockets and streams with green threads,
+# threading (the default) uses a thread per connection. Always explicit, a green server
+# needs the standard library patched, which app.py does before anything else is imported
+ASYNC_MODE = getenv('ASYNC_MODE', 'threading').lower()
+# /feed viewers above this get a snapshot every 1/SNAPSHOT_STREAM_FPS seconds instead, 0 for no limit
+MAX_STREAMS = int(getenv('MAX_STREAMS', 8))
+SNAPSHOT_STREAM_FPS = float(getenv('SNAPSHOT_STREAM_FPS', 1))
+
+# Log every Socket.IO packet, only useful when debugging the dashboard connection
+SOCKETIO_LOGGER = getenv('SOCKETIO_LOGGER', '0') == '1'
 
 app = Flask(__name__, static_folder=static_folder, static_url_path='/')
+# Files are streamed through wsgi.file_wrapper, which servers implement with sendfile where available.
+# Behind Apache or lighttpd the web server can send them itself, set USE_X_SENDFILE=1 for that
+app.config['USE_X_SENDFILE'] = getenv('USE_X_SENDFILE', '0') == '1'
 CORS(app)
\ No newline at end of file
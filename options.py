@@ -1,8 +1,25 @@
+import os
+import logging
+
 from config import options_file
 from json import dump, load
+from contextlib import contextmanager
+from threading import RLock
+from typing import Callable
+
+log = logging.getLogger("CameraSystem")
 
 class Options:
     def __init__(self):
+        # Incremented on every change, stages can compare it to know whether to recompute cached state
+        self._version = 0
+        self._lock = RLock()
+        # (callback, keys) called with the changed keys once a change or batch of changes is applied
+        self._subscribers: list[tuple[Callable, set]] = []
+        # Nesting depth of batch(), changes and whether to save them are collected until the outermost one ends
+        self._batch_depth = 0
+        self._changed = set()
+        self._save_pending = False
         self.logging = False
         self.linelimit: int = 0
         self.recording247 = False
@@ -12,7 +29,15 @@ class Options:
         self.schedule: dict = None
         self.motionwait: int = 5 # seconds
         self.motionrecordto = 10 # seconds
+        self.motionprerollseconds = 3 # seconds before the motion included in motion clips
         self.contourareathreshold = 3000 # roughly thumb size?
+        self.motionanalysiswidth = 320 # pixels, frames are downscaled for motion detection
+        self.motionanalysisfps = 5 # motion detection runs at most this many times a second
+        self.framerate = 20 # fps the camera is captured at
+        self.segmentminutes = 10 # 24/7 recordings are split into files of this length
+        self.retentiondays = 0 # delete recordings older than this, 0 keeps them forever
+        self.retentionmaxgb = 0 # delete the oldest recordings above this total size, 0 for no limit
+        self.retentionminfreegb = 0 # delete the oldest recordings when free disk space drops below this
         self._default_res = 640, 480
         self.resolution = self._default_res
         # The above options above can be overridden by options file
@@ -41,14 +66,55 @@ class Options:
             # Check if the attribute exists
             if key not in self.get_options():
                 return False, f"Option '{key}' does not exist"
-            
-            # Empty values are treated as None, except for boolean values
-            setattr(self, key, None if not value and not isinstance(value, bool) else value)
-            # Save options to file for next run
-            save and self.save_options()
+
+            with self.batch():
+                # Empty values are treated as None, except for booleans and numbers, 0 is a valid setting
+                value = None if not value and not isinstance(value, (bool, int, float)) else value
+                if getattr(self, key) != value:
+                    setattr(self, key, value)
+                    self._version += 1
+                    self._changed.add(key)
+                    # Save options to file for next run, once for the whole batch
+                    self._save_pending = self._save_pending or save
         except Exception as e:
             return str(e)
 
+    @contextmanager
+    def batch(self):
+        """
+        Apply several updates as one: the file is written once and subscribers
+        are notified once with all changed keys when the batch ends.
+        """
+        changed = None
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    changed, self._changed = self._changed, set()
+                    save, self._save_pending = self._save_pending, False
+                    save and self.save_options()
+        # Outside the lock, subscribers may read or update options themselves
+        changed and self._notify(changed)
+
+    @property
+    def version(self):
+        return self._version
+
+    def subscribe(self, callback: Callable, *keys):
+        """Call `callback(changed_keys)` after changes to any of `keys`, or to any option if none are given"""
+        self._subscribers.append((callback, set(keys)))
+
+    def _notify(self, changed: set):
+        for callback, keys in self._subscribers:
+            if not keys or keys & changed:
+                try:
+                    callback(changed)
+                except Exception as e:
+                    log.error(f"Error applying options {', '.join(sorted(changed))}: {e}")
+
     def get_options(self):
         return {
             # Classes are not JSON serializable
@@ -59,8 +125,14 @@ class Options:
         }
 
     def save_options(self):
-        with open(options_file, "w") as f:
-            dump(self.get_options(), f, indent=4)
+        # Written next to it and moved over it, so a power cut never leaves a half written file
+        temp_file = options_file + ".tmp"
+        with self._lock:
+            with open(temp_file, "w") as f:
+                dump(self.get_options(), f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, options_file)
 
 
 options = Options()
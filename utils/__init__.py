@@ -5,91 +5,34 @@ import tempfile
 
 from textwrap import dedent
 from datetime import datetime
-from csv import writer as csv_writer
 from config import *
+from utils.recordings_index import recordings_index, info as video_info
+from utils.thumbnails import thumbnails
+from utils.activitylog import activity_log
 
 def append_log(log_type, short_msg, long_msg) -> list:
-    """Function to append a log to the CSV file"""
-    file_exists = os.path.exists(log_file)
-    should_add_header = not file_exists or os.stat(log_file).st_size < 10
-    log_data = [str(datetime.now()), short_msg, long_msg, log_type]
-
-    with open(log_file, "a", newline="") as f:
-        writer = csv_writer(f)
-        if should_add_header:
-            # Write the header only if the file is newly created or empty
-            writer.writerow(["Timestamp", "Short Message", "Long Message", "Log Type"])
-
-        # Write the actual log data
-        writer.writerow(log_data)
-
-    return log_data
+    """Function to append a log to the activity logs"""
+    return activity_log.append(log_type, short_msg, long_msg)
 
 def get_video_info(name):
-    video_path = os.path.join(recordings_dir, name)
-    if not os.path.isfile(video_path):
-        return "File not found"
-    
-def get_video_info(name):
-    video_path = os.path.join(recordings_dir, name)
-    thumbnail = os.path.join(recordings_dir, f"thumbnails/{os.path.basename(video_path)}.jpg")
-    filename = os.path.basename(video_path)
-
-    if not os.path.isfile(video_path):
-        return print("File not found")
-
-    # If file contains '.processing', it is still being written to,
-    # so return basic info to indicate that
-    if ".processing" in name:
-        return { "filename": filename, "processing": True }
-
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        print("Unable to open recording", path.basename(video_path))
-        return { "filename": filename, "corrupt": True }
-
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    duration = frame_count / fps if fps > 0 else 0
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    # Generate a thumbnail (capture a frame around the middle of the video)
-    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count // 2)
-    ret, frame = cap.read()
-
-    # Only generate a thumbnail if it doesn't already exist 
-    if ret and not os.path.isfile(thumbnail):
-        os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
-        cv2.imwrite(thumbnail, frame)
-
-    cap.release()
-
-    return {
-        'filename': os.path.basename(video_path),
-        'thumbnail': os.path.basename(thumbnail),
-        'size': os.path.getsize(video_path),
-        'duration': duration,
-        'width': width,
-        'height': height,
-    }
+    row = recordings_index.get(os.path.basename(name))
+    return row and video_info(row)
 
 def get_videos():
-    videos = [f for f in os.listdir(recordings_dir) if f.endswith('.mp4')]
-    video_info_list = [get_video_info(name) for name in videos]
-    return [info for info in video_info_list if info]
+    return [video_info(row) for row in recordings_index.list()]
 
-def delete_video(name):
+def delete_video(name, export=True):
     name = os.path.basename(name)
     video_path = os.path.join(recordings_dir, name)
-    thumbnail = os.path.join(recordings_dir, f"thumbnails/{name}.jpg")
-    
+
     if not os.path.isfile(video_path):
         return "File not found"
 
-    # Delete the video file and its thumbnail
-    try: os.remove(video_path), os.remove(thumbnail)
+    # Delete the video file and its thumbnails
+    try: os.remove(video_path)
     except: pass
+    thumbnails.remove(name)
+    recordings_index.remove(name, export)
 
 def clean_filename(filename):
     return filename.replace('.processing', '')
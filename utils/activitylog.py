@@ -0,0 +1,165 @@
+import atexit
+import csv
+import io
+import os
+
+from time import sleep
+from datetime import datetime
+from threading import Thread, Lock
+from typing import Callable
+from config import log_file, LOG_MAX_BYTES, LOG_FLUSH_SECONDS
+from options import options
+
+HEADER = ["Timestamp", "Short Message", "Long Message", "Log Type"]
+KEYS = ["timestamp", "shortMessage", "longMessage", "logType"]
+
+
+class ActivityLog:
+    """
+    Append-only store of the activity logs, in the CSV format the dashboard reads directly.
+
+    The file stays open and entries are flushed in batches every `flush_seconds`.
+    Reading starts from the end of the file, so the newest entries are found without parsing
+    the whole history. Every entry is one line, line breaks in messages are replaced.
+
+    With a line limit the oldest entries are dropped once the file is 10% above the limit,
+    so the file is only rewritten every so often instead of on each entry. Above `max_bytes`
+    the file is moved to `filename`.1 and a new one is started.
+    """
+
+    def __init__(self, filename, line_limit: Callable[[], int] = lambda: 0, max_bytes=0, flush_seconds=1.0):
+        self.filename = filename
+        self.line_limit = line_limit
+        self.max_bytes = max_bytes
+        self.flush_seconds = flush_seconds
+        self._lock = Lock()
+        self._file = None
+        self._lines = 0
+        self._dirty = False
+        self._flusher: Thread = None
+
+    def _open(self):
+        """Open the file for appending, counting its entries and adding the header if it's new"""
+        self._file = open(self.filename, "a", newline="")
+        if self._file.tell() == 0:
+            csv.writer(self._file).writerow(HEADER)
+            self._lines = 0
+            return
+        with open(self.filename, "rb") as f:
+            self._lines = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(64 * 1024), b"")) - 1
+
+    def append(self, log_type, short_msg, long_msg) -> list:
+        log_data = [str(datetime.now()), short_msg, long_msg, log_type]
+        row = [str(value).replace("\r", " ").replace("\n", " ") for value in log_data]
+        with self._lock:
+            if not self._file:
+                self._open()
+            csv.writer(self._file).writerow(row)
+            self._lines += 1
+            self._dirty = True
+            self._enforce_limits()
+        if not self._flusher:
+            self._flusher = Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+        return log_data
+
+    def flush(self):
+        with self._lock:
+            if self._file and self._dirty:
+                self._file.flush()
+                self._dirty = False
+
+    def _flush_loop(self):
+        while True:
+            sleep(self.flush_seconds)
+            self.flush()
+
+    def _enforce_limits(self):
+        limit = self.line_limit()
+        if limit and self._lines > limit + max(limit // 10, 1):
+            self._trim(limit)
+        elif self.max_bytes and self._file.tell() > self.max_bytes:
+            self._file.close()
+            os.replace(self.filename, self.filename + ".1")
+            self._open()
+
+    def _trim(self, keep):
+        """Rewrite the file with only the newest `keep` entries"""
+        self._file.flush()
+        newest = list(self._reverse_lines(keep))
+        temp_name = self.filename + ".tmp"
+        with open(temp_name, "wb") as f:
+            f.write((",".join(HEADER) + "\r\n").encode())
+            f.writelines(line + b"\n" for line in reversed(newest))
+        self._file.close()
+        os.replace(temp_name, self.filename)
+        self._open()
+
+    def _reverse_lines(self, limit=None, block_size=64 * 1024, file=None, size=None):
+        """
+        Raw entry lines from the newest to the oldest, the header excluded.
+        Reads the first `size` bytes of `file` if given, the whole log file otherwise.
+        """
+        with file or open(self.filename, "rb") as f:
+            position = f.seek(0, os.SEEK_END) if size is None else size
+            rest, count = b"", 0
+            while position > 0:
+                size = min(block_size, position)
+                position -= size
+                f.seek(position)
+                lines = (f.read(size) + rest).split(b"\n")
+                # The first line may be incomplete, it's completed by the next block
+                rest = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line
+                        count += 1
+                        if limit and count >= limit:
+                            return
+            # What's left is the header
+
+    def read(self, limit=None, before=None, log_type=None):
+        """
+        Entries newest first as dicts with timestamp, shortMessage, longMessage and logType.
+        `before` only includes entries with an older timestamp, `log_type` only those of that type.
+        """
+        entries = []
+        # Only the size is taken under the lock, the entries up to there are complete. The file is read
+        # without holding it so appending isn't blocked, a trim or rotation replaces the file but not the one opened
+        with self._lock:
+            if self._file and self._dirty:
+                self._file.flush()
+                self._dirty = False
+            if not os.path.exists(self.filename):
+                return []
+            file = open(self.filename, "rb")
+            size = file.seek(0, os.SEEK_END)
+        for line in self._reverse_lines(file=file, size=size):
+            values = next(csv.reader(io.StringIO(line.decode(errors="replace"))), [])
+            if len(values) < len(KEYS):
+                continue
+            entry = dict(zip(KEYS, values))
+            if before and entry["timestamp"] >= before:
+                continue
+            if log_type and entry["logType"] != log_type:
+                continue
+            entries.append(entry)
+            if limit and len(entries) >= limit:
+                break
+        return entries
+
+    def clear(self):
+        with self._lock:
+            self._file and self._file.close()
+            # Replaced rather than truncated, readers keep reading the file they opened
+            temp_name = self.filename + ".tmp"
+            with open(temp_name, "w", newline="") as f:
+                csv.writer(f).writerow(HEADER)
+            os.replace(temp_name, self.filename)
+            self._file = None
+            self._dirty = False
+
+
+activity_log = ActivityLog(log_file, lambda: options.linelimit, LOG_MAX_BYTES, LOG_FLUSH_SECONDS)
+# Entries of the last batch would be lost otherwise
+atexit.register(activity_log.flush)
@@ -4,14 +4,32 @@ import os
 import logging
 
 from enum import Enum
-from time import sleep
+from time import sleep, monotonic
 from threading import Thread, Lock
 from datetime import datetime
 from typing import Callable
 from options import options
 from os import path, rename, remove
-from config import NOT_USING_PYCAMERA, recordings_dir, static_folder
+from config import NOT_USING_PYCAMERA, CAMERA_SOURCE, recordings_dir, static_folder, transcode_queue_file
+from config import TRANSCODE_WORKERS, TRANSCODE_THREADS, TRANSCODE_NICENESS, TRANSCODE_QUEUE_SIZE, PREROLL_MAX_BYTES
+from config import RECORDING_QUEUE_MAX_BYTES, MAX_STREAMS, SNAPSHOT_STREAM_FPS, LIVE_HLS_DIR, LIVE_HLS_FPS, LIVE_HLS_SEGMENT_SECONDS, LIVE_HLS_WINDOW
+from config import RECORDING_ENCODER, RECORDING_PRESET, RECORDING_CHUNK_SECONDS
+from config import PIPELINE_MODE, PIPELINE_JPEG_WORKERS, PIPELINE_MOTION_WORKERS, PIPELINE_SLOTS_PER_WORKER
 from utils import append_log, clean_filename, iso_to_date
+from utils.framebus import FrameBus, FramePool
+from utils.stream import MjpegBroadcaster, PooledMjpegBroadcaster, SnapshotCache, encode_jpeg
+from utils.live import HlsStream
+from utils.transcode import TranscodeQueue
+from utils import recorder
+from utils.shared_encoder import SharedEncoder
+from utils.recordings_index import recordings_index
+from utils.thumbnails import thumbnails
+from utils.motion import MotionDetector, detect_motion, DEFAULT_ANALYSIS_WIDTH
+from utils.preroll import PreRollBuffer
+from utils.privacy import PrivacyZones
+from utils.pacing import FramePacer
+from utils.metrics import metrics, SampledLog
+from utils.retention import enforce_retention
 from apscheduler.schedulers.background import BackgroundScheduler
 
 logging.basicConfig(
@@ -20,6 +38,11 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 log = logging.getLogger("CameraSystem")
+# For messages that could be logged every frame
+sampled_log = SampledLog(log)
+
+# Seconds between retention checks, besides the ones after each finished recording
+RETENTION_INTERVAL = 600
 
 class RecordingsType(Enum):
     """Enumeration for the type of recording"""
@@ -28,12 +51,13 @@ class RecordingsType(Enum):
     MANUAL = "manual"
 
 class Camera:
-    def __init__(self, testing_env=False):
+    def __init__(self, testing_env=False, source=CAMERA_SOURCE):
         self.testing_env = testing_env
+        # Webcam index or video file used in the testing environment
+        self.source = source
         # Internal resolution, might be options.resolution or options._default_res
         # options.resolution can be unset, and may not reflect the actual frame resolution
         self.resolution = options.resolution
-        self.resolution_chnaged = False
         self.capcam: cv2.VideoCapture = None
         self.on_resume: Callable = None
         self.paused = False
@@ -46,12 +70,76 @@ class Camera:
         self.scheduler = BackgroundScheduler()
         self.recordings = {
             # If a value is empty, it means that the recording of type is not in progress
-            # The value is an iterable containing the filename, video writer object, and frame count
+            # The value is a Clip of the shared stream, or a RecordingWriter which encodes the file from its own queue and thread
             RecordingsType.MANUAL: [],
             RecordingsType.SCHEDULED_CLIP: [],
             RecordingsType.MOTION_CLIP: [],
         }
+        # Only guards the registry of recordings (and handing over the pre-roll), never held while writing
         self.recording_lock = Lock()
+        # Recordings of all types that overlap are cut from one encoded stream instead of each encoding the frames
+        self.shared = SharedEncoder(path.join(recordings_dir, ".chunks"), RECORDING_ENCODER, RECORDING_PRESET,
+                                    RECORDING_QUEUE_MAX_BYTES, RECORDING_CHUNK_SECONDS, lambda frame: self.frames.release(frame))
+        # When the current file of each recording type was started, used to split 24/7 recordings
+        self.segment_started = {}
+        # Processed frames are published here once by the background capture loop
+        # and consumed by the feed viewers and the recorder
+        # Buffers of captured and flipped frames are reused once their owners released them
+        self.frame_pool = FramePool()
+        self.frames = FrameBus(pool=self.frame_pool)
+        # Shape of the last captured frame, the webcam reads into a buffer of that shape
+        self.frame_shape = None
+        # Y plane of the lores stream of Picamera2, analysed for motion instead of the full frames
+        self.lores_pool = FramePool()
+        self.motion_frames = FrameBus(pool=self.lores_pool)
+        self.lores_size = None
+        # Keeps the capture loop at options.framerate and measures the rate actually achieved
+        self.pacer = FramePacer(options.framerate or 20)
+        # Worker processes for motion analysis and JPEG encoding, forked here before any other thread is started
+        self.stages = []
+        if PIPELINE_MODE == "processes":
+            from utils.pipeline import ProcessStage
+            self.stages = [ProcessStage("jpeg", encode_jpeg, PIPELINE_JPEG_WORKERS, PIPELINE_SLOTS_PER_WORKER),
+                           ProcessStage("motion", detect_motion, PIPELINE_MOTION_WORKERS, PIPELINE_SLOTS_PER_WORKER)]
+            metrics.gauge("pipeline", "Workers, frames in flight, submitted and dropped per worker process stage",
+                          lambda: {f"{stage.name}_{key}": value for stage in self.stages for key, value in stage.stats().items()})
+            log.info(f"Motion analysis and JPEG encoding run in worker processes, {PIPELINE_JPEG_WORKERS} for JPEG")
+        # Frames are JPEG encoded once and shared between all /feed clients
+        self.mjpeg = PooledMjpegBroadcaster(self.frames, self.stages[0]) if self.stages else MjpegBroadcaster(self.frames)
+        # Still images of the newest frame for /api/snapshot.jpg
+        self.snapshots = SnapshotCache(self.frames)
+        # H.264 alternative to the MJPEG feed, one encoder shared by all viewers while anyone is watching
+        self.live = HlsStream(self.frames, LIVE_HLS_DIR, LIVE_HLS_FPS, LIVE_HLS_SEGMENT_SECONDS, LIVE_HLS_WINDOW, RECORDING_ENCODER)
+        # The last options.motionprerollseconds seconds of frames, prepended to motion clips
+        self.preroll = PreRollBuffer(PREROLL_MAX_BYTES)
+        # Privacy zones of options.shape, compiled for the current resolution
+        self.privacy = PrivacyZones()
+        # Motion detection works on the published frames, independent of anyone watching the feed
+        self.motion = MotionDetector(self.frames, self.start_motion_recording,
+                                     lambda: options.motiondetection and not self.paused and not self.using_pir_sensor,
+                                     self.stages[1] if self.stages else None)
+        # Settings of the pacer and pre-roll follow the options, set again only when one of them changes
+        self.apply_options()
+        options.subscribe(self.apply_options, 'framerate', 'motiondetection', 'motionprerollseconds')
+        metrics.gauge("fps", "Target and measured capture frame rate", self.pacer.stats)
+        metrics.gauge("preroll", "Motion pre-roll buffer length and memory use", self.preroll.stats)
+        metrics.gauge("frames_published", "Frames published by the capture loop", lambda: self.frames.seq)
+        metrics.gauge("frame_pool", "Reusable frame buffers and frames allocated since startup", self.frame_pool.stats)
+        # Feed viewers at the full frame rate and at the snapshot rate, limited to MAX_STREAMS full rate ones
+        self.max_streams = MAX_STREAMS
+        self.streams = {"full": 0, "snapshot": 0}
+        self.streams_lock = Lock()
+        # Cooperative sleep of eventlet/gevent, set when feed generators run in green threads
+        self.stream_sleep: Callable = None
+        metrics.gauge("recordings", "Frames queued, written and dropped per active recording",
+                      lambda: {f"{type.value}_{key}": value for type, recording in self.recordings.items() if recording
+                               for key, value in recording.stats().items()})
+        metrics.gauge("shared_encoder", "Whether the shared recording encoder runs, its clips and position", self.shared.stats)
+        metrics.gauge("streams", "Feed viewers at the full frame rate and at the snapshot rate", lambda: self.streams)
+        metrics.gauge("live_stream_running", "Whether the live HLS encoder is running", lambda: self.live.running)
+        # Finished recordings are converted to H.264 in the background, started after startup cleanup
+        self.transcoder = TranscodeQueue(transcode_queue_file, TRANSCODE_WORKERS, TRANSCODE_THREADS, TRANSCODE_NICENESS, TRANSCODE_QUEUE_SIZE)
+        self.transcoder.on_status = self.on_transcode_status
         log.info("Camera system initialized.")
 
     def __call__(self):
@@ -65,17 +153,15 @@ class Camera:
                     width, height = options.resolution
                 if self.testing_env:
                     self.capcam and self.capcam.release()
-                    self.capcam = cv2.VideoCapture(0)
+                    self.capcam = cv2.VideoCapture(self.source)
                     self.capcam.set(cv2.CAP_PROP_FRAME_WIDTH, width)
                     self.capcam.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
                     self.resolution = width, height
                     if self.capcam is None or not self.capcam.isOpened():
-                        log.error("[DEBUG] Could not open USB camera 0! Is a webcam connected?")
-                        raise Exception("Error: Could not open USB camera 0, is a webcam connected? Unset NOT_USING_PYCAMERA to use Picamera2")
+                        log.error(f"[DEBUG] Could not open USB camera {self.source}! Is a webcam connected?")
+                        raise Exception(f"Error: Could not open USB camera {self.source}, is a webcam connected? Unset NOT_USING_PYCAMERA to use Picamera2")
                     log.info(f"Camera initialized at {width}x{height}")
-                    if not hasattr(self, 'bg_thread') or not self.bg_thread.is_alive():
-                        self.bg_thread = Thread(target=self.background_capture_loop, daemon=True)
-                        self.bg_thread.start()
+                    self.start_threads()
                     return self
                 # Picamera2 module is used for Raspberry Pi camera module
                 if not self.capcam:
@@ -84,13 +170,22 @@ class Camera:
                 else:
                     self.capcam.stop()
                 print(f"Camera resolution set to {width}x{height}")
-                self.capcam.configure(self.capcam.create_video_configuration(main={"size": (width, height)}))
+                # RGB888 is BGR in memory, what OpenCV expects, so frames need no conversion.
+                # The lores stream is only YUV420, its Y plane is the grayscale image motion detection wants
+                lores_width = min(options.motionanalysiswidth or DEFAULT_ANALYSIS_WIDTH, width)
+                config = self.capcam.create_video_configuration(
+                    main={"size": (width, height), "format": "RGB888"},
+                    lores={"size": (lores_width, round(height * lores_width / width)), "format": "YUV420"},
+                )
+                self.capcam.align_configuration(config)
+                self.capcam.configure(config)
                 self.capcam.start()
+                self.lores_size = config["lores"]["size"]
+                self.motion.frames = self.motion_frames
+                self.motion.full_width = width
                 self.resolution = width, height
                 log.info(f"Camera initialized at {width}x{height}")
-                if not hasattr(self, 'bg_thread') or not self.bg_thread.is_alive():
-                    self.bg_thread = Thread(target=self.background_capture_loop, daemon=True)
-                    self.bg_thread.start()
+                self.start_threads()
                 return self
             except Exception as e:
                 log.error(f"Camera init failed: {e}")
@@ -98,16 +193,50 @@ class Camera:
                 sleep(2)
         raise Exception("Camera failed to initialize after retries.")
 
+    def start_threads(self):
+        # The capture loop is the only reader of the camera, everything else consumes self.frames
+        if not hasattr(self, 'bg_thread') or not self.bg_thread.is_alive():
+            self.bg_thread = Thread(target=self.background_capture_loop, daemon=True)
+            self.bg_thread.start()
+        if not hasattr(self, 'rec_thread') or not self.rec_thread.is_alive():
+            self.rec_thread = Thread(target=self.recording_loop, daemon=True)
+            self.rec_thread.start()
+        self.motion.start()
+        if not hasattr(self, 'segment_thread') or not self.segment_thread.is_alive():
+            self.segment_thread = Thread(target=self.segment_loop, daemon=True)
+            self.segment_thread.start()
+
     def capture(self):
+        """Capture a frame into a buffer of the frame pool, the lores image of Picamera2 is published for motion detection"""
         if not self.testing_env:
-            frame = self.capcam.capture_array()
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+            from picamera2 import MappedArray
+            request = self.capcam.capture_request()
+            try:
+                # Views of the camera's own buffers, copied once into ours so the request can be returned
+                with MappedArray(request, "main") as mapped:
+                    frame = self.frame_pool.acquire(mapped.array.shape)
+                    np.copyto(frame, mapped.array)
+                with MappedArray(request, "lores") as mapped:
+                    width, height = self.lores_size
+                    gray = self.lores_pool.acquire((height, width))
+                    np.copyto(gray, mapped.array[:height, :width])
+            finally:
+                request.release()
+            self.motion_frames.publish(gray)
             return True, frame
         else:
-            ret, frame = self.capcam.read()
+            # Decoded into a pooled buffer when the frame size is known, OpenCV allocates one otherwise
+            buffer = self.frame_pool.acquire(self.frame_shape) if self.frame_shape else None
+            ret, frame = self.capcam.read(buffer)
             if not ret:
-                # Probably reached the end of the video if playing from a file
+                # Probably reached the end of the video if playing from a file, start over
                 self.capcam.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ret, frame = self.capcam.read(buffer)
+            if ret:
+                self.frame_shape = frame.shape
+            if buffer is not None and frame is not buffer:
+                # Not read into it, e.g. the size changed
+                self.frame_pool.release(buffer)
             return ret, frame
     def release(self):
         if not self.testing_env:
@@ -128,6 +257,8 @@ class Camera:
         # It's better to release the camera and reinitialize it with the new resolution
         # as changing resolution on the fly with resize() will still capture frames at the old resolution
         self.init_cam(width, height)
+        # The background model of motion detection is of the old frame size
+        self.motion.reset()
         self.unpause(user_initiated=False)
         return width, height
 
@@ -142,24 +273,61 @@ class Camera:
     def toggle_pause(self):
         self.unpause() if self.paused else self.pause()
 
+    def open_recording(self, type):
+        """
+        Start a recording of the given type and register it, replacing the one in progress.
+        With ffmpeg it's a clip of the stream shared by all recording types, otherwise a file
+        with an encoder of its own. Returns (recording, replaced recording), (None, None) if nothing works.
+        """
+        filename = path.join(recordings_dir, f"{datetime.now():%Y-%m-%d_%H-%M-%S}.{type.value}.processing.mp4")
+        # Played back at the rate frames are actually captured, not the rate that was aimed for
+        fps = self.recording_fps()
+        motion = type == RecordingsType.MOTION_CLIP
+        if (recorder.working_backend() or ("",))[0] == "ffmpeg":
+            with self.recording_lock:
+                # Motion clips start with the frames from before the motion was detected,
+                # which are in the stream already if the encoder is running
+                prerolled = self.preroll.detach() if motion and not self.shared.running else []
+                preroll = int((options.motionprerollseconds or 0) * fps) if motion else 0
+                recording = self.shared.open_clip(filename, fps, self.resolution, preroll, prerolled, lambda: self.reclaim_preroll(prerolled))
+                if recording:
+                    return recording, self.register_recording(type, recording)
+                self.preroll.reclaim(prerolled)
+            log.error(f"Could not start the shared encoder, {filename} gets an encoder of its own")
+
+        writer = recorder.open_writer(filename, fps, self.resolution)
+        if not writer:
+            log.error(f"[DEBUG] All codecs failed for {filename}. Recording will not work!")
+            return None, None
+        with self.recording_lock:
+            prerolled = self.preroll.detach() if motion else []
+            recording = recorder.RecordingWriter(filename, writer, RECORDING_QUEUE_MAX_BYTES, prerolled, f"write_{type.value}",
+                                                 lambda: self.reclaim_preroll(prerolled), self.frames.release)
+            return recording, self.register_recording(type, recording)
+
+    def reclaim_preroll(self, frames):
+        """Called by the writer thread once the pre-roll frames are written, their ring can collect frames again"""
+        with self.recording_lock:
+            self.preroll.reclaim(frames)
+
+    def register_recording(self, type, recording):
+        """Called with the recording lock held, returns the recording that was replaced"""
+        previous = self.recordings.get(type)
+        self.recordings[type] = recording
+        self.segment_started[type] = monotonic()
+        return previous
+
     def start_recording(self, type=RecordingsType.MANUAL, notify=True, rec_type="recording247"):
         # إذا كان هناك تسجيل نشط من نفس النوع، أوقفه أولًا
         if self.recordings.get(type):
             log.warning(f"Recording type {type} already in progress. Stopping previous recording.")
             self.stop_recording(type)
-        for codec_name in ["mp4v", "XVID", "avc1"]:
-            codec = cv2.VideoWriter_fourcc(*codec_name)
-            filename = path.join(recordings_dir, f"{datetime.now():%Y-%m-%d_%H-%M-%S}.{type.value}.processing.mp4")
-            writer = cv2.VideoWriter(filename, codec, 20, self.resolution)
-            if writer.isOpened():
-                log.info(f"[DEBUG] VideoWriter opened with codec {codec_name} for {filename}")
-                break
-            else:
-                log.error(f"[DEBUG] VideoWriter failed to open with codec {codec_name} for {filename}")
-        else:
-            log.error(f"[DEBUG] All codecs failed for {filename}. Recording will not work!")
+        recording, _ = self.open_recording(type)
+        if not recording:
             return "VideoWriter failed to open"
-        self.recordings[type] = [filename, writer, 0]  # Add frame count
+        filename = recording.filename
+        # Listed as processing until it's stopped
+        recordings_index.update(filename)
         self.inform('recording', True)
         print(f"Recording {type.value} to {filename}", self.recordings)
         log.info(f"[MANUAL] Started recording: {filename}")
@@ -167,6 +335,43 @@ class Camera:
             self.notify((type.value.replace(RecordingsType.MANUAL.value, "24/7")).capitalize() + " recording started", rec_type)
         log.info(f"Started recording: {filename}")
 
+    def recording_fps(self):
+        target = options.framerate or 20
+        measured = self.pacer.measured_fps
+        return round(min(measured, target), 2) if measured else target
+
+    def finalize_recording(self, recording):
+        """
+        Close a recording (a RecordingWriter or Clip) that no longer receives frames and hand it over for transcoding if it isn't H.264 yet.
+        Returns the final filename, or None if the recording was too short and discarded.
+        """
+        filename = recording.filename
+        new_name = clean_filename(filename)
+        # Waits for the queued frames to be written or the clip to be cut, the capture and other recordings carry on meanwhile
+        frame_count = recording.close()
+        recording.dropped and log.warning(f"{recording.dropped} frames of {new_name} were dropped, storage couldn't keep up")
+        try:
+            rename(filename, new_name)
+        except Exception as e:
+            log.error(f"[DEBUG] Failed to rename {filename} to {new_name}: {e}")
+        MIN_FRAMES = 10
+        if frame_count < MIN_FRAMES or not os.path.exists(new_name):
+            if os.path.exists(new_name):
+                os.remove(new_name)
+            recordings_index.remove(filename)
+            print(f"Recording {new_name} discarded (too short or empty)")
+            log.warning(f"[MANUAL] Recording {new_name} discarded (too short or empty)")
+            return None
+        # Listed straight away, the index is updated again once transcoding changes the file
+        recordings_index.remove(filename, export=False)
+        recordings_index.update(new_name)
+        # Converting to H.264 takes a while, don't hold up whoever stopped the recording.
+        # Thumbnails are made once it's done, or right away if the clip is already H.264 or stays in its original codec
+        if recording.h264 or not self.transcoder.submit(new_name):
+            thumbnails.submit(new_name)
+        log.info(f"Recording {new_name} saved successfully, frames written: {frame_count}")
+        return new_name
+
     def stop_recording(self, type=None, rm_type=True, rec_type="recording247"):
         log.info(f"[DEBUG] stop_recording CALLED with type={type}, rm_type={rm_type}, rec_type={rec_type}")
         if type is None:
@@ -175,83 +380,99 @@ class Camera:
                     self.stop_recording(rec_type)
             log.info(f"[DEBUG] stop_recording: All recordings stopped.")
             return
-        if not self.recordings.get(type):
+        with self.recording_lock:
+            recording = self.recordings.get(type)
+            # A stopped motion clip stays registered during the cooldown, it's left alone
+            in_progress = recording and not recording.closed
+            if in_progress and rm_type:
+                self.recordings[type] = []
+            in_progress and self.segment_started.pop(type, None)
+        if not in_progress:
             log.warning(f"[MANUAL] Tried to stop recording {type} but none in progress.")
             return print("Recording type not in progress")
-        filename, writer, frame_count = self.recordings[type]
-        new_name = clean_filename(filename)
-        with self.recording_lock:
-            writer: cv2.VideoWriter
-            writer.release()
-            try:
-                rename(filename, new_name)
-            except Exception as e:
-                log.error(f"[DEBUG] Failed to rename {filename} to {new_name}: {e}")
-        MIN_FRAMES = 10
-        if frame_count < MIN_FRAMES or not os.path.exists(new_name):
-            if os.path.exists(new_name):
-                os.remove(new_name)
-            if rm_type:
-                del self.recordings[type]
-            print(f"Recording {new_name} discarded (too short or empty)")
-            log.warning(f"[MANUAL] Recording {new_name} discarded (too short or empty)")
+        saved = self.finalize_recording(recording)
+        if not saved:
             log.info(f"[DEBUG] stop_recording: Recording {type} discarded.")
             return
-        if rm_type:
-            del self.recordings[type]
         self.inform('recording', False)
         self.notify((type.value.replace(RecordingsType.MANUAL.value, "24/7")).capitalize() + " recording done", rec_type)
         log.info(f"[DEBUG] stop_recording: Recording {type} stopped and file saved.")
-        import moviepy.editor as moviepy
-        import multiprocessing
-        clip = moviepy.VideoFileClip(new_name)
-        num_cores = multiprocessing.cpu_count()
-        clip.write_videofile(new_name + ".tmp.mp4", codec='libx264', threads=num_cores, preset='ultrafast')
-        clip.close()
-        remove(new_name)
-        rename(new_name + ".tmp.mp4", new_name)
-        log.info(f"[MANUAL] Stopped recording: {new_name}, frames written: {frame_count}")
-        if frame_count < MIN_FRAMES or not os.path.exists(new_name):
-            log.warning(f"Recording {new_name} was too short or empty and was deleted.")
-        else:
-            log.info(f"Recording {new_name} saved successfully.")
-        # تحديث recordings.json بعد حفظ الفيديو
+        self.apply_retention()
+
+    def rollover_recording(self, type=RecordingsType.MANUAL):
+        """
+        Continue a recording in a new file and finalize the previous one on its own,
+        so a long 24/7 recording is made of playable segments of options.segmentminutes.
+        """
+        # Swapped under the lock so no frame ends up in neither segment
+        recording, previous = self.open_recording(type)
+        if not recording:
+            # Keep writing to the current segment rather than losing footage
+            return log.error(f"Could not open the next segment of the {type.value} recording")
+        filename = recording.filename
+        recordings_index.update(filename)
+        log.info(f"Recording {type.value} continues in a new segment: {filename}")
+        if previous:
+            self.finalize_recording(previous)
+        self.apply_retention()
+
+    def apply_retention(self):
+        # Recordings the transcoder or thumbnail worker still has to get to are left for the next check
         try:
-            import json
-            json_path = os.path.join('frontend/public/recordings', 'recordings.json')
-            if os.path.exists(json_path):
-                with open(json_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            else:
-                data = []
-            # أضف الفيديو إذا لم يكن موجودًا
-            base_name = os.path.basename(new_name)
-            if not any(rec.get('name') == base_name for rec in data):
-                # استخراج معلومات الفيديو
-                size_mb = round(os.path.getsize(new_name) / 1_000_000, 2)
-                cap = cv2.VideoCapture(new_name)
-                frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                fps = cap.get(cv2.CAP_PROP_FPS)
-                duration = round(frame_count / fps, 1) if fps > 0 else 0
-                cap.release()
-                data.append({
-                    'name': base_name,
-                    'url': f"/recordings/{base_name}",
-                    'date': str(datetime.now().strftime('%Y-%m-%d %H:%M')),
-                    'duration': f"{duration}s",
-                    'size': f"{size_mb} MB"
-                })
-                with open(json_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
+            deleted = enforce_retention(lambda name: self.transcoder.busy(name) or thumbnails.busy(name))
         except Exception as e:
-            log.error(f"Failed to update recordings.json: {e}")
+            # Never fails the recording that triggered the check, the next check tries again
+            return log.error(f"Failed to apply the retention policy: {e}")
+        if deleted and options.logging:
+            log_data = append_log("retention", "Old recordings deleted", f"Retention policy deleted {len(deleted)} recording(s): {', '.join(deleted)}")
+            self.inform("new-log", log_data)
+
+    def segment_loop(self):
+        retention_checked = monotonic()
+        while True:
+            sleep(1)
+            try:
+                # Recordings also age out while nothing is being recorded
+                if monotonic() - retention_checked >= RETENTION_INTERVAL:
+                    retention_checked = monotonic()
+                    self.apply_retention()
+            except Exception as e:
+                log.error(f"Error in segment_loop: {e}")
+            try:
+                # Chunks of the shared stream nobody needs anymore, the pre-roll of the next motion clip is kept
+                preroll = (options.motiondetection and options.motionprerollseconds) or 0
+                self.shared.keep_frames = int(preroll * self.recording_fps())
+                self.shared.discard()
+            except Exception as e:
+                log.error(f"Error discarding recorded chunks: {e}")
+            try:
+                # Only 24/7 recordings are split into segments
+                started = self.segment_started.get(RecordingsType.MANUAL)
+                if options.recording247 and options.segmentminutes and started \
+                        and monotonic() - started >= options.segmentminutes * 60:
+                    self.rollover_recording(RecordingsType.MANUAL)
+            except Exception as e:
+                log.error(f"Error in segment_loop: {e}")
+
+    def on_transcode_status(self, filename, status):
+        if status == "ready":
+            recordings_index.update(filename)
+        if status in ("ready", "failed"):
+            # The recording is final now, a failed transcode still leaves the original file
+            thumbnails.submit(filename)
+        self.inform and self.inform('transcode', {"filename": path.basename(filename), "status": status})
+
+    def on_thumbnail_ready(self, filename, thumbnail):
+        recordings_index.set_thumbnail(filename, thumbnail)
+        # The thumbnail exists already, dashboards that aren't linked yet just miss the event
+        self.inform and self.inform('thumbnail', {"filename": filename, "thumbnail": thumbnail})
 
     def start_motion_recording(self):
         if self.recordings.get(RecordingsType.MOTION_CLIP):
             return "Motion recording is already in progress"
 
         self.start_recording(RecordingsType.MOTION_CLIP, notify=False)
-        filename = clean_filename(path.basename(self.recordings[RecordingsType.MOTION_CLIP][0]))
+        filename = clean_filename(path.basename(self.recordings[RecordingsType.MOTION_CLIP].filename))
 
         if options.logging:
             # Log after recording has started to avoid logging if recording fails to start
@@ -267,17 +488,21 @@ class Camera:
         sleep(delay)
 
         # Stop recording
+        clip = self.recordings.get(RecordingsType.MOTION_CLIP)
         cam_utils.stop_recording(RecordingsType.MOTION_CLIP, rm_type=False, rec_type="motion")
 
         # Wait for options.motionwait before allowing motion detection again
         self.notify(f"Motion detection cooling for {options.motionwait}s", "motion")
         sleep(options.motionwait)
-        del self.recordings[RecordingsType.MOTION_CLIP]
+        with self.recording_lock:
+            # Only the clip this timer stopped, never one started since
+            if self.recordings.get(RecordingsType.MOTION_CLIP) is clip:
+                self.recordings[RecordingsType.MOTION_CLIP] = []
         # self.notify("Motion detection resumed", "motion")
 
     def start_scheduled_recording(self, start_time, end_time):
         self.start_recording(RecordingsType.SCHEDULED_CLIP, notify=False)
-        filename = clean_filename(path.basename(self.recordings[RecordingsType.SCHEDULED_CLIP][0]))
+        filename = clean_filename(path.basename(self.recordings[RecordingsType.SCHEDULED_CLIP].filename))
 
         if options.logging:
             log_data = append_log("schedule", "Scheduled recording started.", f"Scheduled recording started at {start_time} and will end at {end_time}. Recording to {filename}")
@@ -321,34 +546,6 @@ class Camera:
             self.scheduler.start()
         
 
-    def detect_motion(self, frame, frist_gray_frame):
-        # https://pyimagesearch.com/2015/05/25/basic-motion-detection-and-tracking-with-python-and-opencv/
-        gray2 = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.GaussianBlur(gray2, (21, 21), 0)
-
-        # Calculate the difference between the two frames.
-        delta_frame = cv2.absdiff(frist_gray_frame, gray2)
-
-        # Threshold the delta frame.
-        thresh = cv2.threshold(delta_frame, 100, 255, cv2.THRESH_BINARY)[1]
-
-        # Dilate the thresholded image to fill in holes.
-        thresh = cv2.dilate(thresh, None, iterations=2)
-
-        # Find contours to detect the moving parts.
-        contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        for contour in contours:
-            if cv2.contourArea(contour) < options.contourareathreshold:
-                continue  # Too small
-
-            # (x, y, w, h) = cv2.boundingRect(contour)
-            # cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-            log.info("Motion detected! Starting recording...")
-            self.start_motion_recording()
-            return gray2.copy()
-        
-        return gray2.copy()
-
     def match_option(self, key, value):
         log.info(f"[DEBUG] match_option CALLED with key={key}, value={value}")
         """
@@ -362,7 +559,6 @@ class Camera:
         if key == 'resolution' and not value:
             self.set_resolution(*options._default_res)
             title, desc = "Resolution set to default", f"Camera resolution automatically set to {'x'.join(map(str, options._default_res))}"
-            self.resolution_chnaged = True
         elif key == 'resolution' and value != options.resolution:
             self.set_resolution(*value)
             title = "Camera resolution updated"
@@ -376,16 +572,14 @@ class Camera:
                     title, desc, successful = "Invalid resolution", "Resolution must be at least 100x100", False
         elif key == 'recording247':
             if value:
+                # Set before the recording starts so it's split into segments from the start
+                options.update_option('recording247', True)
                 msg = self.start_recording()
-                from options import options as _options
-                _options.update_option('recording247', True)
-                _options.reload()
+                msg and options.update_option('recording247', False)
                 title, desc, successful = ("Recording error", msg, 0) if msg else ("Recording on", "24/7 recording enabled", 1)
             else:
+                options.update_option('recording247', False)
                 msg = self.stop_recording(RecordingsType.MANUAL, rec_type="recording247")
-                from options import options as _options
-                _options.update_option('recording247', False)
-                _options.reload()
                 title, desc, successful = ("Recording off", "24/7 recording disabled", 1)
         elif key == 'fliporientation':
             # Some options just need to be toggled, which is done where this function is called, so we just return the title and description
@@ -401,6 +595,17 @@ class Camera:
             title, desc = "Motion detection cooldown updated", f"Updated motion detection cooldown to {value} seconds"
         elif key == 'motionwait' and value != options.motionwait and value == 0:
             title, desc = "Motion cooldown disabled", f"Disabled motion detection cooldown"
+        elif key == 'motionprerollseconds' and value != options.motionprerollseconds and value > 0:
+            title, desc = "Motion pre-roll updated", f"Motion clips start {value} seconds before the motion"
+        elif key == 'motionprerollseconds' and value != options.motionprerollseconds and value == 0:
+            title, desc = "Motion pre-roll disabled", f"Motion clips start when the motion is detected"
+        elif key == 'framerate' and value != options.framerate and value > 0:
+            title, desc = "Frame rate updated", f"Camera frame rate set to {value} fps"
+        elif key == 'segmentminutes' and value != options.segmentminutes and value > 0:
+            title, desc = "Segment length updated", f"24/7 recordings are split into {value} minute files"
+        elif key in ('retentiondays', 'retentionmaxgb', 'retentionminfreegb') and value != getattr(options, key):
+            limit = {'retentiondays': f"{value} days old", 'retentionmaxgb': f"{value} GB in total", 'retentionminfreegb': f"less than {value} GB free"}[key]
+            title, desc = "Retention updated", f"Oldest recordings are deleted at {limit}" if value else "Retention limit disabled"
         elif key == 'schedule' and value:
             msg = self.setup_scheduled_recording(value.get('date', {}).get('from'), value.get('date', {}).get('to'))
             title, desc, successful = ("Schedule error", msg, 0) if msg else ("Recording scheduled", f"Automatic recording set at {value.get('date', {}).get('from')} to {value.get('date', {}).get('to')}", 1)
@@ -420,137 +625,111 @@ class Camera:
         # Returning title and description if there was a match
         return (title, desc, key, successful) if desc else None
 
-    def blend_colour_with_frame(self, frame_roi, colour, alpha):
-        # Create a coloured overlay
-        overlay = np.full(frame_roi.shape, colour, dtype=np.uint8)
-        
-        # Blend the overlay with the frame ROI
-        cv2.addWeighted(overlay, alpha, frame_roi, 1 - alpha, 0, frame_roi)
-        
-        return frame_roi
-
-    def add_privacy_shape(self, frame, shape_attributes):
-        # Calculate absolute dimensions based on relative shape attributes
-        height, width = frame.shape[:2]
-        abs_x = int(shape_attributes['x'] * width / 100)
-        abs_y = int(shape_attributes['y'] * height / 100)
-        abs_width = int(shape_attributes['width'] * width / 100)
-        abs_height = int(shape_attributes['height'] * height / 100)
-        
-        # Create a mask where the shape is located
-        mask = np.zeros(frame.shape[:2], dtype=np.uint8)
-        cv2.rectangle(mask, (abs_x, abs_y), (abs_x + abs_width, abs_y + abs_height), 255, -1)
-
-        # Only apply the Gaussian blur if the blur value is greater than 0
-        if shape_attributes['blur'] > 0:
-            blurred_frame = cv2.GaussianBlur(frame, (0, 0), max(shape_attributes['blur'] - 3, 1))
-        else:
-            blurred_frame = frame
-
-        # Combine the blurred frame and the original frame using the mask
-        combined = np.where(mask[:, :, None], blurred_frame, frame)
-
-        # Extract the ROI from the combined frame
-        combined_roi = combined[abs_y:abs_y+abs_height, abs_x:abs_x+abs_width]
-
-        # Convert HSVA to BGR and apply the alpha channel
-        hsva = shape_attributes['hsva']
-        colour = cv2.cvtColor(np.uint8([[[
-            hsva['h'] / 360 * 179,  # OpenCV Hue range is from 0 to 179 for 8-bit images
-            hsva['s'] / 100 * 255,
-            hsva['v'] / 100 * 255
-        ]]]), cv2.COLOR_HSV2BGR)[0][0].tolist()
-        alpha = hsva['a']
+    def add_privacy_shape(self, frame, shapes):
+        # Zones are compiled once per change of options.shape or resolution, only their pixels are processed
+        return self.privacy.apply(frame, shapes)
 
-        # Blend the coloured overlay with the blurred ROI
-        combined_roi = self.blend_colour_with_frame(combined_roi, colour, alpha)
-
-        # Place the blended ROI back into the combined frame
-        combined[abs_y:abs_y+abs_height, abs_x:abs_x+abs_width] = combined_roi
-        
-        return combined
+    def apply_options(self, changed=()):
+        """Apply the options the capture and recording loops depend on, called when they change"""
+        self.pacer.fps = options.framerate or 20
+        with self.recording_lock:
+            self.preroll.seconds = (options.motiondetection and options.motionprerollseconds) or 0
+            # Sized for the target rate, the measured rate fluctuates and would reallocate the ring
+            self.preroll.fps = options.framerate or 20
 
     def background_capture_loop(self):
-        _, first_frame = self.capture()
-        frist_gray_frame = cv2.cvtColor(first_frame, cv2.COLOR_BGR2GRAY)
-        frist_gray_frame = cv2.GaussianBlur(frist_gray_frame, (21, 21), 0)
         while True:
             try:
                 if self.paused:
+                    self.pacer.reset()
                     sleep(0.1)
                     continue
-                ret, frame = self.capture()
+                # Wait for the deadline of the next frame, processing time counts towards it
+                self.pacer.wait()
+                with metrics.time("capture"):
+                    ret, frame = self.capture()
                 if not ret:
-                    log.error("[DEBUG] No frame captured from camera!")
+                    frame is not None and self.frame_pool.release(frame)
+                    sampled_log("no-frame", "[DEBUG] No frame captured from camera!", logging.ERROR)
                     sleep(0.1)
                     continue
                 else:
-                    log.info("[DEBUG] Frame captured from camera.")
+                    sampled_log("frame", "[DEBUG] Frame captured from camera.")
                 # (Optional) Add privacy, flip, etc. if needed
                 if options.shape:
-                    hsva = options.shape['hsva']
-                    hsva_adjusted = {
-                        **hsva,
-                        's': hsva['s'] * 70,
-                        'v': hsva['v'] * 1.5,
-                    }
                     try:
-                        frame = self.add_privacy_shape(frame, {**options.shape, 'hsva': hsva_adjusted})
+                        with metrics.time("privacy"):
+                            frame = self.add_privacy_shape(frame, options.shape)
                     except Exception as e:
-                        log.error(f"Privacy zone blur failed: {e}")
+                        sampled_log("privacy", f"Privacy zone blur failed: {e}", logging.ERROR)
                 if options.fliporientation:
-                    frame = cv2.flip(frame, -1)
-                with self.recording_lock:
-                    for rec_type, recording in self.recordings.items():
-                        if recording:
-                            recording[1].write(frame)
-                            recording[2] += 1
-                            log.info(f"[DEBUG] Frame written to {recording[0]}")
-                            if recording[2] == 1:
-                                log.info(f"First frame written to {recording[0]}")
-                sleep(1/20)  # match FPS
+                    with metrics.time("flip"):
+                        flipped = cv2.flip(frame, -1, dst=self.frame_pool.acquire(frame.shape))
+                        self.frame_pool.release(frame)
+                        frame = flipped
+                # Recordings must be written at the actual frame size
+                self.resolution = frame.shape[:2][::-1]
+                # Hand the processed frame over to the viewers and the recorder
+                self.frames.publish(frame)
             except Exception as e:
                 log.error(f"Error in background_capture_loop: {e}")
                 sleep(1)
 
-    def gen_frames(self):
-        _, first_frame = self.capture()
-        frist_gray_frame = cv2.cvtColor(first_frame, cv2.COLOR_BGR2GRAY)
-        frist_gray_frame = cv2.GaussianBlur(frist_gray_frame, (21, 21), 0)
-        while not self.paused:
+    def recording_loop(self):
+        # Recorders want every frame, not just the newest one
+        seq = self.frames.seq
+        while True:
             try:
-                ret, frame = self.capture()
-                if not ret:
-                    log.warning("Failed to capture frame from camera.")
+                published = self.frames.wait(seq, newest=False)
+                if not published:
                     continue
-                # (Optional) Motion detection, privacy, flip, etc. as before
-                if options.motiondetection and not self.paused and not self.using_pir_sensor:
-                    if self.resolution_chnaged:
-                        frist_gray_frame = cv2.resize(frist_gray_frame, self.resolution)
-                        self.resolution_chnaged = False
-                    frist_gray_frame = self.detect_motion(frame, frist_gray_frame.copy())
-                if options.shape:
-                    hsva = options.shape['hsva']
-                    hsva_adjusted = {
-                        **hsva,
-                        's': hsva['s'] * 70,
-                        'v': hsva['v'] * 1.5,
-                    }
-                    try:
-                        frame = self.add_privacy_shape(frame, {**options.shape, 'hsva': hsva_adjusted})
-                    except Exception as e:
-                        log.error(f"Privacy zone blur failed: {e}")
-                if options.fliporientation:
-                    frame = cv2.flip(frame, -1)
-                # Remove frame writing from here (now handled by background thread)
-                self.resolution = frame.shape[:2][::-1]
-                ret, buffer = cv2.imencode('.jpg', frame)
-                frame = buffer.tobytes()
-                yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+                seq, frame, _ = published
+                try:
+                    with self.recording_lock:
+                        # Keep the last few seconds around for the next motion clip
+                        self.preroll.push(frame)
+                        recordings = [recording for recording in self.recordings.values() if isinstance(recording, recorder.RecordingWriter)]
+                    # Only queued here, encoded once for all clips of the shared stream,
+                    # recordings with an encoder of their own are written by their own thread.
+                    # Each queue holds on to the frame until it's written
+                    for recording in (self.shared, *recordings):
+                        self.frames.retain(frame)
+                        recording.put(frame)
+                finally:
+                    self.frames.release(frame)
             except Exception as e:
-                log.error(f"Error in gen_frames loop: {e}")
+                log.error(f"Error in recording_loop: {e}")
                 sleep(1)
 
+    def gen_frames(self):
+        # Frames come from the background capture loop, privacy zone and flip are already applied
+        with self.streams_lock:
+            # Viewers above the limit get a snapshot now and then instead of every frame
+            snapshot = bool(self.max_streams) and self.streams["full"] >= self.max_streams
+            self.streams["snapshot" if snapshot else "full"] += 1
+        pacer = FramePacer(SNAPSHOT_STREAM_FPS) if snapshot else None
+        snapshot and log.info(f"More than {self.max_streams} feed viewers, new viewer gets {SNAPSHOT_STREAM_FPS} fps")
+        seq = self.frames.seq - 1
+        try:
+            while not self.paused:
+                try:
+                    pacer and pacer.wait(self.stream_sleep or sleep)
+                    # Encoded once per frame no matter how many clients are watching
+                    encoded = self.mjpeg.next_part(seq, sleep=self.stream_sleep)
+                    if not encoded:
+                        log.warning("No new frame from the capture loop.")
+                        continue
+                    seq, part = encoded
+                    if part:
+                        yield part
+                except Exception as e:
+                    log.error(f"Error in gen_frames loop: {e}")
+                    (self.stream_sleep or sleep)(1)
+        finally:
+            # Also reached when the client disconnects
+            with self.streams_lock:
+                self.streams["snapshot" if snapshot else "full"] -= 1
+
 
 # testing_env is True when running on a non-Raspberry Pi environment and thus using a usb webcam instead of Picamera
 cam_utils: Camera = Camera(testing_env=NOT_USING_PYCAMERA).init_cam()
@@ -581,13 +760,24 @@ if cam_utils.using_pir_sensor:
     pir.when_motion = on_motion
     pir.when_no_motion = on_no_motion
 
-# Clean up broken files on startup
-for file in os.listdir(recordings_dir):
-    if file.endswith('.mp4'):
-        file_path = os.path.join(recordings_dir, file)
-        cap = cv2.VideoCapture(file_path)
-        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-        cap.release()
-        if frames < 10:
-            os.remove(file_path)
-            print(f"Deleted broken recording: {file}")
+# Clean up broken files on startup, only files that changed since the last run are probed
+recordings_index.sync()
+for row in recordings_index.list():
+    if row["frames"] < 10 and not row["processing"]:
+        os.remove(os.path.join(recordings_dir, row["name"]))
+        recordings_index.remove(row["name"], export=False)
+        print(f"Deleted broken recording: {row['name']}")
+recordings_index.export_json()
+
+
+def start_services():
+    """Start the background services, once cam_utils.inform and cam_utils.notify are set"""
+    # Resume transcoding recordings left over from the last run
+    cam_utils.transcoder.start()
+
+    # Create thumbnails in the background, including the ones missing from before
+    thumbnails.on_ready = cam_utils.on_thumbnail_ready
+    thumbnails.start()
+    for row in recordings_index.list():
+        if not (row["processing"] or row["corrupt"]) and not thumbnails.exists(row["name"]):
+            thumbnails.submit(row["name"])
@@ -0,0 +1,79 @@
+import logging
+
+from collections import deque
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable
+from utils.metrics import metrics
+
+log = logging.getLogger("CameraSystem")
+
+# Only the latest value of these matters, a newer one replaces one that wasn't sent yet
+STATE_EVENTS = ('recording', 'paused', 'system-pause')
+
+
+class EventQueue:
+    """
+    Outbound socket events, sent by a single emitter so the camera, scheduler and timer
+    threads never wait for a slow client.
+
+    Events are sent in batches every `batch_window` seconds, state events that weren't
+    sent yet are replaced by newer ones. A new-log of None clears the logs on the dashboard,
+    so log entries still waiting are dropped. The time between queueing and sending is
+    recorded as the emit stage of the metrics.
+
+    Has the same emit(event, data) signature as SocketIO, so it can be used in its place.
+    """
+
+    def __init__(self, emit: Callable, batch_window=0.05, maxsize=1000):
+        self._emit = emit
+        self.batch_window = batch_window
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._pending = deque()
+        # Entries of the state events in _pending, to replace their data
+        self._states = {}
+        self.emitted = 0
+        self.dropped = 0
+        metrics.gauge("events", "Socket events waiting, sent and dropped", self.stats)
+
+    def emit(self, event, data=None):
+        with self._lock:
+            if event in STATE_EVENTS and event in self._states:
+                self._states[event][1] = data
+                return
+            if event == 'new-log' and data is None:
+                self._pending = deque(entry for entry in self._pending if entry[0] != 'new-log')
+            if len(self._pending) >= self.maxsize:
+                dropped = self._pending.popleft()
+                self._states.pop(dropped[0], None)
+                self.dropped += 1
+            entry = [event, data, monotonic()]
+            self._pending.append(entry)
+            if event in STATE_EVENTS:
+                self._states[event] = entry
+
+    def run(self, sleep: Callable = sleep):
+        """
+        Send the queued events, forever. Runs as a background task of the server, which is a
+        green thread with eventlet/gevent, so it waits with their cooperative `sleep`.
+        """
+        latency = metrics.histogram("emit")
+        while True:
+            # Also lets a burst of events (e.g. recording and new-log when motion starts) collect
+            sleep(self.batch_window)
+            if not self._pending:
+                continue
+            with self._lock:
+                batch, self._pending = self._pending, deque()
+                self._states.clear()
+            for event, data, queued in batch:
+                try:
+                    self._emit(event, data)
+                    self.emitted += 1
+                except Exception as e:
+                    log.error(f"Failed to emit {event}: {e}")
+                latency.observe(monotonic() - queued)
+
+    def stats(self):
+        return {"pending": len(self._pending), "emitted": self.emitted, "dropped": self.dropped}
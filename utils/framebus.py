@@ -0,0 +1,138 @@
+import numpy as np
+
+from threading import Condition, Lock
+from time import monotonic
+
+
+class FrameBus:
+    """
+    Single-producer ring buffer of processed frames.
+
+    The background capture loop is the only producer, every published frame gets
+    an increasing sequence number. Consumers (feed viewers, recorders) keep track
+    of the last sequence number they have seen and block until a newer one arrives,
+    so the camera is only read once per frame no matter how many consumers there are.
+
+    With a FramePool the bus owns the published frames until they leave the ring, and
+    frames returned by latest() and wait() are retained for the consumer, which must
+    release() them when done.
+    """
+
+    def __init__(self, size=8, poll_interval=0.01, pool: "FramePool" = None):
+        self.size = size
+        self.poll_interval = poll_interval
+        self.pool = pool
+        # Each slot holds (seq, frame, monotonic timestamp) or None
+        self._slots = [None] * size
+        self._cond = Condition()
+        self.seq = 0
+
+    def publish(self, frame):
+        """Publish a frame, frames must not be modified after being published. The publisher's ownership is handed over"""
+        with self._cond:
+            self.seq += 1
+            replaced = self._slots[self.seq % self.size]
+            self._slots[self.seq % self.size] = (self.seq, frame, monotonic())
+            replaced and self.release(replaced[1])
+            self._cond.notify_all()
+            return self.seq
+
+    def latest(self):
+        """Most recent (seq, frame, timestamp) or None if nothing was published yet"""
+        with self._cond:
+            return self._retained(self._slots[self.seq % self.size]) if self.seq else None
+
+    def wait(self, after=0, timeout=1.0, newest=True, sleep=None):
+        """
+        Block until a frame with a sequence number greater than `after` is available.
+        Returns (seq, frame, timestamp) or None on timeout.
+
+        Viewers want the `newest` frame and skip anything in between,
+        recorders want every frame so they get the oldest one still in the ring.
+
+        Green threads (eventlet/gevent) must not block on the condition, they pass
+        their cooperative `sleep` and poll instead, yielding to the other green threads.
+        """
+        if sleep:
+            deadline = monotonic() + timeout
+            while self.seq <= after:
+                if monotonic() >= deadline:
+                    return None
+                sleep(self.poll_interval)
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.seq > after, timeout):
+                return None
+            if newest or self.seq - after >= self.size:
+                # Consumer fell behind more than the ring can hold, frames in between are lost
+                seq = self.seq if newest else self.seq - self.size + 1
+            else:
+                seq = after + 1
+            return self._retained(self._slots[seq % self.size])
+
+    def _retained(self, published):
+        self.pool and self.pool.retain(published[1])
+        return published
+
+    def retain(self, frame):
+        """Keep a frame from being reused, e.g. while it's queued, until it's released"""
+        self.pool and self.pool.retain(frame)
+
+    def release(self, frame):
+        """Done with a frame returned by latest() or wait(), or retained"""
+        self.pool and self.pool.release(frame)
+
+
+class FramePool:
+    """
+    Recycles frame buffers, so capturing and processing frames allocates nothing once running.
+
+    Ownership is counted explicitly: acquire() hands out a buffer with a count of one, everyone
+    who keeps it beyond that retains it and releases it when done, and at zero it's handed out
+    again. Up to `max_buffers` buffers are tracked, beyond that (and for frames that don't come
+    from the pool) frames are plain arrays and retain and release do nothing.
+    """
+
+    def __init__(self, max_buffers=64):
+        self.max_buffers = max_buffers
+        self._free: list[np.ndarray] = []
+        # id of a tracked buffer -> [buffer, count], the buffers are kept alive here so ids aren't reused
+        self._owners: dict[int, list] = {}
+        self._tracked = 0
+        self._lock = Lock()
+        self.allocated = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        """An uninitialised array of `shape` nothing else uses, owned by the caller"""
+        shape = tuple(shape)
+        with self._lock:
+            while self._free:
+                buffer = self._free.pop()
+                if buffer.shape == shape and buffer.dtype == dtype:
+                    self._owners[id(buffer)] = [buffer, 1]
+                    return buffer
+                # From before a resolution change
+                self._tracked -= 1
+            buffer = np.empty(shape, dtype)
+            self.allocated += 1
+            if self._tracked < self.max_buffers:
+                self._tracked += 1
+                self._owners[id(buffer)] = [buffer, 1]
+            return buffer
+
+    def retain(self, frame):
+        with self._lock:
+            owner = self._owners.get(id(frame))
+            if owner and owner[0] is frame:
+                owner[1] += 1
+
+    def release(self, frame):
+        with self._lock:
+            owner = self._owners.get(id(frame))
+            if owner and owner[0] is frame:
+                owner[1] -= 1
+                if owner[1] == 0:
+                    del self._owners[id(frame)]
+                    self._free.append(frame)
+
+    def stats(self):
+        return {"buffers": self._tracked, "free": len(self._free), "allocated": self.allocated}
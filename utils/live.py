@@ -0,0 +1,151 @@
+import os
+import shutil
+import logging
+import subprocess
+
+from time import monotonic, sleep
+from threading import Thread, Lock, Event
+from utils.framebus import FrameBus
+from utils.pacing import FramePacer
+from utils.metrics import metrics
+from utils.recorder import ffmpeg_binary
+
+log = logging.getLogger("CameraSystem")
+
+HLS_PLAYLIST = "index.m3u8"
+HLS_MIMETYPES = {".m3u8": "application/vnd.apple.mpegurl", ".m4s": "video/iso.segment", ".mp4": "video/mp4"}
+
+
+class HlsStream:
+    """
+    Live HLS stream of the published frames, encoded once to H.264 in fMP4 segments
+    and shared by all viewers, which costs a fraction of the bandwidth of the MJPEG feed.
+
+    The encoder starts when the playlist is first requested and stops when nobody asked
+    for it for `idle_timeout` seconds. ffmpeg keeps a sliding window of `window` segments
+    in `directory`, which should be a tmpfs so segments never touch the SD card.
+    Segment names include the start time of the encoder, so a segment never changes once
+    written and can be cached by the browser and any proxy in between.
+    """
+
+    def __init__(self, frames: FrameBus, directory, fps=15, segment_seconds=2, window=6,
+                 encoder="libx264", idle_timeout=30):
+        self.frames = frames
+        self.directory = directory
+        self.fps = fps
+        self.segment_seconds = segment_seconds
+        self.window = window
+        self.encoder = encoder
+        self.idle_timeout = idle_timeout
+        self.process: subprocess.Popen = None
+        self.size = None
+        self._lock = Lock()
+        self._requested = Event()
+        self._last_request = 0
+        self._thread: Thread = None
+
+    @property
+    def playlist(self):
+        return os.path.join(self.directory, HLS_PLAYLIST)
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def request(self):
+        """
+        Called for every playlist request, starts the encoder if needed. Returns True if the
+        playlist exists, right away, the client retries while the first segment is encoded
+        rather than holding a server worker (or green thread) waiting for it.
+        """
+        self._last_request = monotonic()
+        with self._lock:
+            if not self._thread:
+                self._thread = Thread(target=self.run, daemon=True)
+                self._thread.start()
+        self._requested.set()
+        return os.path.exists(self.playlist)
+
+    def path(self, name):
+        """Path of a file of the stream, or None for names that aren't part of it"""
+        if name != os.path.basename(name) or os.path.splitext(name)[1] not in HLS_MIMETYPES:
+            return None
+        return os.path.join(self.directory, name)
+
+    def start(self, width, height):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = f"{int(monotonic() * 1000)}"
+        args = [
+            ffmpeg_binary(), "-hide_banner", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(self.fps), "-i", "-",
+            "-c:v", self.encoder, "-pix_fmt", "yuv420p",
+            # A keyframe at the start of every segment, so each segment can be played on its own
+            "-g", str(self.fps * self.segment_seconds), "-keyint_min", str(self.fps * self.segment_seconds),
+        ]
+        if self.encoder == "libx264":
+            args += ["-preset", "ultrafast", "-tune", "zerolatency", "-sc_threshold", "0"]
+        args += [
+            "-f", "hls", "-hls_time", str(self.segment_seconds), "-hls_list_size", str(self.window),
+            "-hls_flags", "delete_segments+independent_segments+omit_endlist+temp_file",
+            "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", f"{prefix}-init.mp4",
+            "-hls_segment_filename", os.path.join(self.directory, f"{prefix}-%d.m4s"),
+            self.playlist,
+        ]
+        try:
+            self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except (OSError, TypeError) as e:
+            # TypeError when there is no ffmpeg binary at all
+            log.error(f"Could not start the live stream encoder: {e}")
+            self.process = None
+            return False
+        self.size = width, height
+        log.info(f"Live stream started at {width}x{height}, {self.fps} fps")
+        return True
+
+    def stop(self):
+        if self.process:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+            self.process = None
+            log.info("Live stream stopped, no viewers left")
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run(self):
+        # Frames are fed at a constant rate, repeating the last one if capture is slower,
+        # so the timeline of the stream follows the wall clock
+        pacer = FramePacer(self.fps)
+        while True:
+            if monotonic() - self._last_request > self.idle_timeout:
+                self.stop()
+                self._requested.clear()
+                self._requested.wait()
+                pacer.reset()
+
+            pacer.wait()
+            published = self.frames.latest()
+            if not published:
+                continue
+            frame = published[1]
+            try:
+                self.feed(frame)
+            finally:
+                self.frames.release(frame)
+
+    def feed(self, frame):
+        """Write a frame to the encoder, (re)starting it if needed"""
+        size = frame.shape[1], frame.shape[0]
+        if not self.running or size != self.size:
+            # Started, restarted after a resolution change or after the encoder died
+            self.stop()
+            if not self.start(*size):
+                sleep(5)
+                return
+        try:
+            with metrics.time("hls"):
+                self.process.stdin.write(frame.data if frame.flags.c_contiguous else frame.tobytes())
+        except (BrokenPipeError, ValueError):
+            log.error("Live stream encoder stopped unexpectedly")
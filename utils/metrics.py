@@ -0,0 +1,169 @@
+import logging
+
+from array import array
+from threading import Lock
+from bisect import bisect_left
+from time import monotonic, perf_counter
+from typing import Callable
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is everything above
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+
+    Counts live in preallocated arrays so observing a value doesn't allocate anything.
+    Stages can be timed from several threads at once (recording writers, feed viewers),
+    so observations are locked.
+    """
+
+    def __init__(self):
+        self.counts = array('Q', bytes(8 * (len(BUCKETS) + 1)))
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def reset(self):
+        with self._lock:
+            self.counts[:] = array('Q', bytes(8 * len(self.counts)))
+            self.sum = 0.0
+            self.count = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect_left(BUCKETS, seconds)] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def quantile(self, q):
+        """Estimated from the buckets, i.e. the upper bound of the bucket the quantile falls in"""
+        if not self.count:
+            return 0
+        rank, seen = q * self.count, 0
+        for bound, count in zip((*BUCKETS, float('inf')), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float('inf') else BUCKETS[-1]
+        return BUCKETS[-1]
+
+
+class Timer:
+    """Context manager timing one pass through a stage, a new one is used for every pass"""
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *_):
+        self.histogram.observe(perf_counter() - self.start)
+
+
+class Metrics:
+    """
+    Per stage timings of the capture pipeline plus gauges, exposed in the Prometheus text format.
+
+        with metrics.time('capture'):
+            frame = camera.capture()
+    """
+
+    def __init__(self, prefix="camera"):
+        self.prefix = prefix
+        self.stages: dict[str, Histogram] = {}
+        self.gauges: dict[str, tuple] = {}
+        self._lock = Lock()
+
+    def time(self, stage):
+        # The start time is kept per pass, passes of a stage on different threads can overlap
+        return Timer(self.histogram(stage))
+
+    def histogram(self, stage):
+        """Histogram of a stage, for durations that aren't measured around a block of code"""
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(stage, Histogram())
+        return histogram
+
+    def reset(self):
+        for histogram in self.stages.values():
+            histogram.reset()
+
+    def gauge(self, name, help, get: Callable):
+        """Register a value that is read when the metrics are collected"""
+        self.gauges[name] = help, get
+
+    def snapshot(self):
+        """Summary of the stages and gauges, for the stats socket event"""
+        return {
+            "stages": {
+                stage: {
+                    "count": histogram.count,
+                    "mean_ms": round(histogram.sum / histogram.count * 1000, 3) if histogram.count else 0,
+                    "p50_ms": histogram.quantile(0.5) * 1000,
+                    "p95_ms": histogram.quantile(0.95) * 1000,
+                    "p99_ms": histogram.quantile(0.99) * 1000,
+                } for stage, histogram in self.stages.items()
+            },
+            **{name: collect(get) for name, (_, get) in self.gauges.items()},
+        }
+
+    def render(self):
+        """Prometheus text exposition format"""
+        name = f"{self.prefix}_stage_seconds"
+        lines = [f"# HELP {name} Time spent in each stage of the capture pipeline", f"# TYPE {name} histogram"]
+        for stage, histogram in self.stages.items():
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        for gauge, (help, get) in self.gauges.items():
+            value = collect(get)
+            name = f"{self.prefix}_{gauge}"
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                # A gauge can report several values, labelled by key
+                lines.extend(f'{name}{{key="{key}"}} {float(v)}' for key, v in value.items() if isinstance(v, (int, float)))
+            else:
+                lines.append(f"{name} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def collect(get):
+    try:
+        return get()
+    except Exception:
+        return 0
+
+
+class SampledLog:
+    """
+    Logs a message at most once per `interval` seconds per key, with the number of messages skipped.
+    Meant for things that happen every frame, logging those every time is a cost of its own.
+    """
+
+    def __init__(self, logger: logging.Logger, interval=30):
+        self.logger = logger
+        self.interval = interval
+        self._last: dict[str, float] = {}
+        self._skipped: dict[str, int] = {}
+
+    def __call__(self, key, message, level=logging.INFO):
+        now = monotonic()
+        if now - self._last.get(key, -self.interval) < self.interval:
+            self._skipped[key] = self._skipped.get(key, 0) + 1
+            return
+        skipped = self._skipped.pop(key, 0)
+        self._last[key] = now
+        self.logger.log(level, f"{message} ({skipped} similar messages skipped)" if skipped else message)
+
+
+metrics = Metrics()
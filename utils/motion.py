@@ -0,0 +1,155 @@
+import cv2
+import logging
+import numpy as np
+
+from time import monotonic, sleep
+from threading import Thread
+from typing import Callable
+from options import options
+from utils.framebus import FrameBus
+from utils.metrics import metrics
+
+log = logging.getLogger("CameraSystem")
+
+# Frames are analysed at this width (options.motionanalysiswidth) unless configured otherwise
+DEFAULT_ANALYSIS_WIDTH = 320
+# How fast the background model adapts to changes in the scene, between 0 and 1
+BACKGROUND_LEARNING_RATE = 0.05
+# Minimum brightness difference from the background for a pixel to count as moving
+DELTA_THRESHOLD = 100
+
+
+class MotionDetector:
+    """
+    Frame difference motion detection running on its own thread.
+
+    Frames are taken from the frame bus, so motion is detected whether or not anyone is watching the feed.
+    They are analysed downscaled to grayscale at options.motionanalysiswidth pixels wide, at most
+    options.motionanalysisfps times a second, against a running average of the scene rather than
+    a single reference frame. Grayscale frames, like the Y plane of the lores stream of Picamera2,
+    are used as they are. Intermediate images are kept between analyses instead of reallocated.
+
+    With a `stage` (PIPELINE_MODE processes) the analysis runs in a worker process instead,
+    see detect_motion.
+    """
+
+    def __init__(self, frames: FrameBus, on_motion: Callable, active: Callable[[], bool], stage=None):
+        self.frames = frames
+        self.on_motion = on_motion
+        # Motion detection can be disabled, paused or replaced by a PIR sensor
+        self.active = active
+        self.stage = stage
+        self._background = None
+        # The background of the worker process is forgotten with the next frame
+        self._reset_worker = False
+        self._buffers: dict[str, np.ndarray] = {}
+        # Width of the frames options.contourareathreshold refers to, when `frames` is a smaller stream
+        self.full_width: int = None
+
+    def start(self):
+        if not hasattr(self, 'thread') or not self.thread.is_alive():
+            self.thread = Thread(target=self.run, name="motion", daemon=True)
+            self.thread.start()
+
+    def reset(self):
+        """Forget the background, e.g. after the resolution changed or detection was off for a while"""
+        self._background = None
+        self._reset_worker = True
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        """The intermediate image `name`, reallocated only when its shape changes"""
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._buffers[name] = np.empty(shape, dtype)
+        return buffer
+
+    def prepare(self, frame, analysis_width=None):
+        """Downscaled, blurred grayscale version of a frame"""
+        height, width = frame.shape[:2]
+        analysis_width = min(analysis_width or options.motionanalysiswidth or DEFAULT_ANALYSIS_WIDTH, width)
+        size = (round(height * analysis_width / width), analysis_width)
+        if size != (height, width):
+            frame = cv2.resize(frame, size[::-1], dst=self.buffer("small", (*size, *frame.shape[2:])), interpolation=cv2.INTER_AREA)
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.buffer("gray", size))
+        # Same amount of blur relative to the frame as the 21x21 kernel at 640px wide
+        kernel = max(3, round(21 * analysis_width / 640) | 1)
+        # Never in place, the frame may be a published one
+        return cv2.GaussianBlur(frame, (kernel, kernel), 0, dst=self.buffer("blurred", size))
+
+    def analyse(self, frame, analysis_width=None, area_threshold=None, full_width=None):
+        """Update the background model with a frame and return True if it contains motion"""
+        gray = self.prepare(frame, analysis_width)
+        if area_threshold is None:
+            area_threshold = options.contourareathreshold
+
+        if self._background is None or self._background.shape != gray.shape:
+            self._background = gray.astype("float32")
+            return False
+
+        # https://pyimagesearch.com/2015/06/01/home-surveillance-and-motion-detection-with-the-raspberry-pi-python-and-opencv/
+        background = cv2.convertScaleAbs(self._background, dst=self.buffer("background", gray.shape))
+        delta = cv2.absdiff(gray, background, dst=self.buffer("delta", gray.shape))
+        cv2.accumulateWeighted(gray, self._background, BACKGROUND_LEARNING_RATE)
+
+        # Threshold the delta frame and dilate it to fill in holes
+        cv2.threshold(delta, DELTA_THRESHOLD, 255, cv2.THRESH_BINARY, dst=delta)
+        cv2.dilate(delta, None, dst=delta, iterations=2)
+
+        # options.contourareathreshold is in pixels of the full size frame
+        scale = (gray.shape[1] / (full_width or frame.shape[1])) ** 2
+        contours, _ = cv2.findContours(delta, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return any(cv2.contourArea(contour) >= area_threshold * scale for contour in contours)
+
+    def run(self):
+        seq = 0
+        next_analysis = monotonic()
+        while True:
+            try:
+                if not self.active():
+                    self.reset()
+                    sleep(0.5)
+                    continue
+
+                # Analysis rate is independent of the capture frame rate
+                now = monotonic()
+                if now < next_analysis:
+                    sleep(next_analysis - now)
+                next_analysis = max(next_analysis + 1 / (options.motionanalysisfps or 1), monotonic())
+
+                published = self.frames.wait(seq)
+                if not published:
+                    continue
+                seq, frame, _ = published
+
+                try:
+                    with metrics.time("motion"):
+                        if self.stage:
+                            # The worker has a copy of the options from when it was started, so they're passed along
+                            args = (options.motionanalysiswidth, options.contourareathreshold, self.full_width, self._reset_worker)
+                            self._reset_worker = False
+                            moving = self.stage.call(frame, args)
+                        else:
+                            moving = self.analyse(frame, full_width=self.full_width)
+                finally:
+                    self.frames.release(frame)
+                if moving:
+                    log.info("Motion detected! Starting recording...")
+                    self.on_motion()
+            except Exception as e:
+                log.error(f"Error in motion detection: {e}")
+                sleep(1)
+
+
+# The detector of a motion worker process, keeping the background model between frames
+_worker_detector: MotionDetector = None
+
+
+def detect_motion(frame, analysis_width, area_threshold, full_width, reset):
+    """Function of the motion ProcessStage, runs in the worker process"""
+    global _worker_detector
+    if _worker_detector is None:
+        _worker_detector = MotionDetector(None, None, None)
+    if reset:
+        _worker_detector.reset()
+    return _worker_detector.analyse(frame, analysis_width, area_threshold, full_width)
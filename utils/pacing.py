@@ -0,0 +1,60 @@
+from collections import deque
+from time import monotonic, sleep
+
+
+class FramePacer:
+    """
+    Paces a loop to a target frame rate using monotonic deadlines.
+
+    Unlike sleeping a fixed time after each frame, the time spent processing a frame counts
+    towards its slot. When the loop falls behind, the missed slots are skipped instead of
+    the whole schedule sliding back. The rate actually achieved is measured over the last few seconds.
+    """
+
+    def __init__(self, fps=20, window=2):
+        self.window = window
+        self.skipped = 0
+        self._next = None
+        self._fps = None
+        self.fps = fps
+
+    @property
+    def fps(self):
+        return self._fps
+
+    @fps.setter
+    def fps(self, fps):
+        # The measurement covers `window` seconds, which is a different number of frames at another rate
+        if fps != self._fps:
+            self._fps = fps
+            self._times = deque(maxlen=max(int(fps * self.window), 2))
+
+    def reset(self):
+        """Start over, e.g. after being paused"""
+        self._next = None
+        self._times.clear()
+
+    def wait(self, sleep=sleep):
+        """Sleep until the next frame is due, green threads pass their cooperative `sleep`"""
+        period = 1 / self.fps
+        now = monotonic()
+        if self._next is None:
+            self._next = now
+        if now < self._next:
+            sleep(self._next - now)
+        elif now - self._next >= period:
+            # Behind by at least one whole frame, drop the slots that were missed
+            missed = int((now - self._next) / period)
+            self.skipped += missed
+            self._next += missed * period
+        self._next += period
+        self._times.append(monotonic())
+
+    @property
+    def measured_fps(self):
+        if len(self._times) < 2 or self._times[-1] == self._times[0]:
+            return 0
+        return (len(self._times) - 1) / (self._times[-1] - self._times[0])
+
+    def stats(self):
+        return {"target_fps": self.fps, "measured_fps": round(self.measured_fps, 2), "skipped_frames": self.skipped}
@@ -0,0 +1,238 @@
+import atexit
+import logging
+import multiprocessing
+import numpy as np
+
+from itertools import count
+from threading import Thread, Lock, Event
+from typing import Callable
+from multiprocessing import shared_memory, resource_tracker, reduction
+from multiprocessing.connection import Connection, wait
+
+log = logging.getLogger("CameraSystem")
+
+
+def worker_main(function, connection):
+    """Loop of a worker process: run `function` on frames in shared memory and send back the results"""
+    memory = None
+    while True:
+        try:
+            task_id, name, offset, shape, args = connection.recv()
+        except EOFError:
+            # The stage was closed
+            return
+        if memory is None or memory.name != name:
+            # The parent replaced the shared memory, e.g. after a resolution change
+            memory and memory.close()
+            # Registered with the resource tracker of the parent, which the workers share
+            memory = shared_memory.SharedMemory(name=name)
+        frame = np.ndarray(shape, np.uint8, buffer=memory.buf, offset=offset)
+        try:
+            result = function(frame, *args)
+        except Exception as e:
+            log.error(f"Pipeline worker failed: {e}")
+            result = None
+        del frame
+        connection.send((task_id, result))
+
+
+def launcher_main(function, control, parent_end):
+    """
+    Loop of the launcher process: start a worker for each name asked for and send back the parent's end of its pipe.
+    The launcher is forked while the server process has a single thread and never starts any, so the workers it
+    forks can't inherit locks other threads were holding (logging, OpenCV's thread pool), even when restarted later
+    """
+    # Inherited when forked, it would keep the pipe from closing when the stage does
+    parent_end.close()
+    context = multiprocessing.get_context("fork")
+    workers = {}
+    while True:
+        try:
+            name = control.recv()
+        except EOFError:
+            # The stage was closed, the daemonic workers are terminated when this process exits
+            return
+        old = workers.pop(name, None)
+        if old:
+            # Replacing a worker that died
+            old.join(1)
+            log.error(f"{name} worker process exited with code {old.exitcode}, starting it again")
+        connection, child = context.Pipe()
+        process = context.Process(target=worker_main, args=(function, child), name=name, daemon=True)
+        process.start()
+        child.close()
+        reduction.send_handle(control, connection.fileno(), None)
+        connection.close()
+        workers[name] = process
+
+
+class ProcessStage:
+    """
+    Runs `function(frame, *args)` in `workers` worker processes, which can use the other cores
+    without competing for the GIL of the capture process.
+
+    Frames are copied once into slots of a shared memory block and the workers work on NumPy
+    views of them, only the slot position and the (small) result are pickled. There are
+    `slots_per_worker` slots per worker, submitting while all of them are in use fails and counts
+    as dropped: the stage can't keep up and the frame is skipped rather than queued.
+
+    Each worker has a pipe of its own, so the frames it was working on are known if it dies:
+    their slots are freed, their callbacks get None and the worker is started again.
+
+    Workers are forked by a launcher process, which is forked when the stage is created,
+    so stages should be created before other threads are started.
+    """
+
+    def __init__(self, name, function: Callable, workers=1, slots_per_worker=2):
+        self.name = name
+        self.function = function
+        self.slots = max(workers, 1) * slots_per_worker
+        self.submitted = 0
+        self.dropped = 0
+        self.restarts = 0
+        self._free = list(range(self.slots))
+        # task id -> (slot, callback, index of the worker)
+        self._pending: dict[int, tuple] = {}
+        self._ids = count()
+        self._lock = Lock()
+        self._memory: shared_memory.SharedMemory = None
+        self._slot_size = 0
+
+        self._closed = False
+        context = multiprocessing.get_context("fork")
+        # Started before forking so the workers share it, one of their own would unlink the memory when they exit
+        resource_tracker.ensure_running()
+        self._control, child = context.Pipe()
+        self._launcher = context.Process(target=launcher_main, args=(function, child, self._control), name=f"{name}-launcher")
+        self._launcher.start()
+        child.close()
+        # Connection per worker, None once the worker died
+        self._workers: list[Connection] = [None] * max(workers, 1)
+        for index in range(len(self._workers)):
+            self._start_worker(index)
+        Thread(target=self._collect, name=f"{name}-results", daemon=True).start()
+        atexit.register(self.close)
+
+    def _start_worker(self, index):
+        self._control.send(f"{self.name}-{index}")
+        self._workers[index] = Connection(reduction.recv_handle(self._control))
+
+    def _allocate(self, nbytes):
+        """Make the slots big enough for frames of `nbytes`, only while no frames are in flight"""
+        old = self._memory
+        self._memory = shared_memory.SharedMemory(create=True, size=nbytes * self.slots)
+        self._slot_size = nbytes
+        if old:
+            old.close()
+            old.unlink()
+
+    def submit(self, frame, args=(), callback: Callable = None):
+        """Hand a frame to the workers, `callback(result)` is called with the result. Returns False if all slots are busy"""
+        with self._lock:
+            # The least busy worker that's alive, dead ones are started again by _collect
+            load = {index: 0 for index, connection in enumerate(self._workers) if connection}
+            for _, _, index in self._pending.values():
+                if index in load:
+                    load[index] += 1
+            # Frames that don't fit wait for the frames in flight, the memory is replaced then
+            if not load or not self._free or (frame.nbytes > self._slot_size and self._pending):
+                self.dropped += 1
+                return False
+            if frame.nbytes > self._slot_size:
+                self._allocate(frame.nbytes)
+            index = min(load, key=load.get)
+            slot = self._free.pop()
+            task_id = next(self._ids)
+            offset = slot * self._slot_size
+            np.copyto(np.ndarray(frame.shape, np.uint8, buffer=self._memory.buf, offset=offset), frame)
+            self._pending[task_id] = slot, callback, index
+            self.submitted += 1
+            try:
+                self._workers[index].send((task_id, self._memory.name, offset, frame.shape, args))
+            except OSError:
+                # Died just now, the slot is freed with the other frames of the worker
+                pass
+        return True
+
+    def call(self, frame, args=(), timeout=5.0):
+        """Run the function on a frame and wait for the result, None if it failed or the stage is busy"""
+        done, result = Event(), []
+        if not self.submit(frame, args, lambda value: (result.append(value), done.set())):
+            return None
+        done.wait(timeout)
+        return result[0] if result else None
+
+    def _collect(self):
+        while not self._closed:
+            connections = [connection for connection in self._workers if connection]
+            try:
+                ready = wait(connections, timeout=1)
+            except (OSError, ValueError):
+                # Closed while waiting
+                continue
+            dead = []
+            for connection in ready:
+                try:
+                    task_id, result = connection.recv()
+                except (EOFError, OSError):
+                    # The worker died, handled below
+                    dead.append(self._workers.index(connection))
+                    continue
+                with self._lock:
+                    task = self._pending.pop(task_id, None)
+                    if not task:
+                        continue
+                    self._free.append(task[0])
+                self._callback(task[1], result)
+            dead and self._restart_dead(dead)
+
+    def _restart_dead(self, dead):
+        """Free the slots of workers that died, e.g. killed for running out of memory, and start them again"""
+        lost = []
+        with self._lock:
+            if self._closed:
+                return
+            for index in dead:
+                connection, self._workers[index] = self._workers[index], None
+                for task_id, (slot, callback, worker) in list(self._pending.items()):
+                    if worker == index:
+                        del self._pending[task_id]
+                        self._free.append(slot)
+                        lost.append(callback)
+                connection.close()
+                try:
+                    self._start_worker(index)
+                except (EOFError, OSError) as e:
+                    # The launcher itself is gone, the remaining workers carry on
+                    log.error(f"Could not start another {self.name} worker: {e}")
+                    continue
+                self.restarts += 1
+        for callback in lost:
+            self._callback(callback, None)
+
+    def _callback(self, callback, result):
+        if callback:
+            try:
+                callback(result)
+            except Exception as e:
+                log.error(f"Error handling a {self.name} result: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        # Workers exit when their pipe closes, the launcher when its pipe closes and takes any stragglers with it
+        for connection in self._workers:
+            connection and connection.close()
+        self._control.close()
+        self._launcher.join(5)
+        self._launcher.is_alive() and self._launcher.terminate()
+        if self._memory:
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+    def stats(self):
+        return {"workers": len(self._workers), "busy": self.slots - len(self._free),
+                "submitted": self.submitted, "dropped": self.dropped, "restarts": self.restarts}
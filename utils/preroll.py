@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class PreRollBuffer:
+    """
+    Fixed memory ring of the most recent frames, so that motion clips can start
+    a few seconds before the motion that triggered them.
+
+    Frames are copied into preallocated NumPy arrays, nothing is allocated per frame.
+    There are two rings of half of `max_bytes` each: detach() lends the frames of one to a
+    recording, which gives it back with reclaim() once they are written, while the other keeps
+    collecting. A ring holds `seconds * fps` frames but never more than its half of `max_bytes`.
+    If both rings are lent out, frames aren't collected until one is given back.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.seconds = 0
+        self.fps = 20
+        self._rings: list[np.ndarray] = [None, None]
+        self._lent = [False, False]
+        # Index of the ring frames are collected into, None while both are lent
+        self._active = 0
+        self._start = 0
+        self._count = 0
+
+    def capacity(self, frame):
+        return max(0, min(int((self.seconds or 0) * self.fps), self.max_bytes // 2 // frame.nbytes))
+
+    def push(self, frame):
+        capacity = self.capacity(frame)
+        if capacity == 0:
+            return self.release()
+        if self._active is None:
+            return
+
+        # (Re)allocate when first used, or after the resolution or the length changed
+        ring = self._rings[self._active]
+        if ring is None or ring.shape != (capacity, *frame.shape):
+            ring = self._rings[self._active] = np.empty((capacity, *frame.shape), dtype=frame.dtype)
+            self._start = self._count = 0
+
+        np.copyto(ring[(self._start + self._count) % capacity], frame)
+        if self._count < capacity:
+            self._count += 1
+        else:
+            # Full, the oldest frame was just overwritten
+            self._start = (self._start + 1) % capacity
+
+    def detach(self):
+        """
+        Return the buffered frames, oldest first, and continue in the other ring.
+        The returned frames stay valid until they are given back with reclaim().
+        """
+        if self._active is None or self._count == 0:
+            return []
+        index, ring, start, count = self._active, self._rings[self._active], self._start, self._count
+        self._lent[index] = True
+        self._active = None if self._lent[1 - index] else 1 - index
+        self._start = self._count = 0
+        return [ring[(start + i) % len(ring)] for i in range(count)]
+
+    def reclaim(self, frames):
+        """Give back the frames returned by detach(), once they have been written"""
+        for index, ring in enumerate(self._rings):
+            if frames and ring is not None and frames[0].base is ring:
+                self._lent[index] = False
+                if not self.seconds:
+                    self._rings[index] = None
+                if self._active is None:
+                    self._active = index
+
+    def release(self):
+        """Free the memory, e.g. while motion detection is off. Lent rings are freed once reclaimed"""
+        self._rings = [ring if lent else None for ring, lent in zip(self._rings, self._lent)]
+        self._start = self._count = 0
+
+    def stats(self):
+        return {
+            "seconds": self.seconds,
+            "frames": self._count,
+            "capacity": 0 if self._active is None or self._rings[self._active] is None else len(self._rings[self._active]),
+            "bytes": sum(ring.nbytes for ring in self._rings if ring is not None),
+            "max_bytes": self.max_bytes,
+        }
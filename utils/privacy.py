@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+
+# The zone colour is made more vivid on the feed than in the colour picker
+SATURATION_FACTOR = 70
+VALUE_FACTOR = 1.5
+
+
+class Zone:
+    """A privacy zone converted to pixels for one frame size"""
+
+    def __init__(self, shape, frame_shape):
+        height, width = frame_shape[:2]
+        if 'points' in shape:
+            # Polygon, points are [x, y] percentages of the frame size
+            points = np.array([[x * width / 100, y * height / 100] for x, y in shape['points']], dtype=np.int32)
+            x, y, w, h = cv2.boundingRect(points)
+        else:
+            x, y = int(shape['x'] * width / 100), int(shape['y'] * height / 100)
+            w, h = int(shape['width'] * width / 100), int(shape['height'] * height / 100)
+
+        # Only the part of the zone that is inside the frame
+        self.x0, self.y0 = max(x, 0), max(y, 0)
+        self.x1, self.y1 = min(x + w, width), min(y + h, height)
+        roi_shape = (max(self.y1 - self.y0, 0), max(self.x1 - self.x0, 0), *frame_shape[2:])
+
+        self.sigma = max(shape['blur'] - 3, 1) if shape.get('blur', 0) > 0 else 0
+
+        # Convert HSVA to BGR once instead of for every frame
+        hsva = shape['hsva']
+        self.alpha = hsva['a']
+        colour = cv2.cvtColor(np.uint8([[[
+            hsva['h'] / 360 * 179,  # OpenCV Hue range is from 0 to 179 for 8-bit images
+            min(hsva['s'] * SATURATION_FACTOR / 100 * 255, 255),
+            min(hsva['v'] * VALUE_FACTOR / 100 * 255, 255),
+        ]]]), cv2.COLOR_HSV2BGR)[0][0].tolist()
+        self.overlay = np.full(roi_shape, colour, dtype=np.uint8)
+
+        # Polygons are drawn through a mask of their bounding box, rectangles don't need one
+        self.mask = self.scratch = None
+        if 'points' in shape:
+            self.mask = np.zeros(roi_shape[:2], dtype=np.uint8)
+            cv2.fillPoly(self.mask, [points - (self.x0, self.y0)], 255)
+            self.scratch = np.empty(roi_shape, dtype=np.uint8)
+
+    @property
+    def empty(self):
+        return self.x1 <= self.x0 or self.y1 <= self.y0
+
+    def apply(self, frame):
+        """Blur and tint the zone in place, only the pixels of the zone are touched"""
+        roi = frame[self.y0:self.y1, self.x0:self.x1]
+        target = roi if self.mask is None else self.scratch
+
+        if self.sigma:
+            cv2.GaussianBlur(roi, (0, 0), self.sigma, dst=target)
+        elif target is not roi:
+            np.copyto(target, roi)
+        cv2.addWeighted(self.overlay, self.alpha, target, 1 - self.alpha, 0, dst=target)
+
+        if self.mask is not None:
+            cv2.copyTo(self.scratch, self.mask, roi)
+
+
+class PrivacyZones:
+    """
+    Applies the privacy zones of options.shape to frames.
+
+    options.shape is a single zone or a list of zones. A zone is either a rectangle
+    ({x, y, width, height}) or a polygon ({points: [[x, y], ...]}), in percentages of the frame size,
+    with a blur amount and an HSVA colour. Zones are compiled to pixel coordinates only when
+    the shapes or the frame size change.
+    """
+
+    def __init__(self):
+        self._shapes = None
+        self._frame_shape = None
+        self._zones: list[Zone] = []
+
+    def compile(self, shapes, frame_shape):
+        shapes = shapes if isinstance(shapes, list) else [shapes]
+        zones = [Zone(shape, frame_shape) for shape in shapes if shape]
+        return [zone for zone in zones if not zone.empty]
+
+    def apply(self, frame, shapes):
+        """Apply the zones to the frame in place and return it"""
+        # options.shape is replaced, not mutated, when the zones are edited
+        if shapes is not self._shapes or frame.shape != self._frame_shape:
+            self._zones = self.compile(shapes, frame.shape)
+            self._shapes, self._frame_shape = shapes, frame.shape
+        for zone in self._zones:
+            zone.apply(frame)
+        return frame
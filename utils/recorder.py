@@ -0,0 +1,246 @@
+import cv2
+import shutil
+import logging
+import subprocess
+
+from collections import deque
+from typing import Callable
+from threading import Thread, Condition
+from config import RECORDING_BACKEND, RECORDING_ENCODER, RECORDING_PRESET
+from utils.metrics import metrics, SampledLog
+
+log = logging.getLogger("CameraSystem")
+sampled_log = SampledLog(log)
+
+# OpenCV codecs tried in order when ffmpeg can't be used, the output is transcoded afterwards
+OPENCV_CODECS = ["mp4v", "XVID", "avc1"]
+
+# The first backend that worked, so later recordings don't probe again.
+# ("ffmpeg", encoder) or ("opencv", codec name)
+_working_backend = None
+
+
+def ffmpeg_binary():
+    """ffmpeg from PATH, or the one that comes with moviepy"""
+    binary = shutil.which("ffmpeg")
+    if binary:
+        return binary
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return None
+
+
+def probe_ffmpeg(encoder):
+    """Encode a few blank frames to check the encoder is available, e.g. h264_v4l2m2m on a Pi"""
+    binary = ffmpeg_binary()
+    if not binary:
+        return False
+    try:
+        result = subprocess.run(
+            (binary, "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "color=size=64x64:duration=0.2",
+             "-c:v", encoder, "-pix_fmt", "yuv420p", "-f", "null", "-"),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=20,
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.warning(f"Could not probe ffmpeg encoder {encoder}: {e}")
+        return False
+    if result.returncode != 0:
+        log.warning(f"ffmpeg encoder {encoder} is not usable: {result.stderr.decode(errors='replace').strip()}")
+    return result.returncode == 0
+
+
+class FfmpegWriter:
+    """
+    Drop-in replacement for cv2.VideoWriter that pipes raw BGR frames into an ffmpeg process,
+    producing browser playable H.264 in one pass, so the recording doesn't need to be transcoded.
+    """
+    h264 = True
+
+    def __init__(self, filename, fps, size, encoder="libx264", preset="ultrafast", output=None):
+        self.filename = filename
+        self.size = tuple(size)
+        width, height = self.size
+        args = [
+            ffmpeg_binary(), "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+            "-c:v", encoder, "-pix_fmt", "yuv420p",
+        ]
+        # Hardware encoders don't know about x264 presets
+        if encoder == "libx264":
+            args += ["-preset", preset]
+        # Playable while downloading and seekable in the browser, unless other output options are given
+        args += output or ["-movflags", "+faststart", filename]
+        try:
+            self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            log.error(f"Could not start ffmpeg for {filename}: {e}")
+            self.process = None
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def write(self, frame):
+        if not self.isOpened():
+            return
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            # Same as cv2.VideoWriter, frames of another size are skipped
+            return
+        try:
+            # No copy for contiguous frames, which is what the pipeline produces
+            self.process.stdin.write(frame.data if frame.flags.c_contiguous else frame.tobytes())
+        except (BrokenPipeError, ValueError):
+            log.error(f"ffmpeg stopped unexpectedly while recording {self.filename}")
+            self.process.poll()
+
+    def release(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            # The moov atom is moved to the front on exit, which takes a moment for long recordings
+            self.process.wait(timeout=120)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        if self.process.returncode:
+            log.error(f"ffmpeg exited with {self.process.returncode} for {self.filename}")
+        self.process = None
+
+
+def working_backend():
+    """("ffmpeg", encoder), ("opencv", codec name) or None if OpenCV hasn't been tried yet, probed once"""
+    global _working_backend
+
+    if _working_backend is None:
+        if RECORDING_BACKEND == "ffmpeg" and probe_ffmpeg(RECORDING_ENCODER):
+            _working_backend = "ffmpeg", RECORDING_ENCODER
+        log.info(f"Recording with {_working_backend or 'OpenCV'}")
+    return _working_backend
+
+
+def open_writer(filename, fps, size):
+    """
+    Open a writer for a new recording. Tries ffmpeg with the configured H.264 encoder first,
+    then the OpenCV codecs. The first one that works is remembered for the next recordings.
+    Returns None if nothing works.
+    """
+    global _working_backend
+
+    working_backend()
+    if _working_backend and _working_backend[0] == "ffmpeg":
+        writer = FfmpegWriter(filename, fps, size, _working_backend[1], RECORDING_PRESET)
+        if writer.isOpened():
+            return writer
+        log.error(f"ffmpeg failed to start for {filename}, falling back to OpenCV")
+
+    codecs = [_working_backend[1]] if _working_backend and _working_backend[0] == "opencv" else OPENCV_CODECS
+    for codec_name in codecs:
+        writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*codec_name), fps, size)
+        if writer.isOpened():
+            log.info(f"[DEBUG] VideoWriter opened with codec {codec_name} for {filename}")
+            if not _working_backend:
+                _working_backend = "opencv", codec_name
+            return writer
+        log.error(f"[DEBUG] VideoWriter failed to open with codec {codec_name} for {filename}")
+
+    # The remembered codec stopped working, probe everything again next time
+    _working_backend = None
+    return None
+
+
+def needs_transcode(writer):
+    """Recordings made by OpenCV aren't H.264 and have to be converted to play in the browser"""
+    return not getattr(writer, "h264", False)
+
+
+class RecordingWriter:
+    """
+    A recording in progress, written by its own thread from a bounded queue of frames,
+    so a slow disk never holds up capture or the other recordings.
+
+    The queue holds at most `max_bytes` of frames. When storage falls behind the oldest
+    frames are dropped and counted, the recording skips ahead rather than falling further behind.
+    Frames given when starting (the motion pre-roll) are always written, `on_prerolled`
+    is called once they are. Queued frames are retained by whoever puts them and handed
+    to `release` once written or dropped, see FrameBus.retain.
+    """
+
+    def __init__(self, filename, writer, max_bytes, frames=(), stage="write", on_prerolled: Callable = None,
+                 release: Callable = None):
+        self.filename = filename
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self.stage = stage
+        self.capacity = None
+        # Kept apart from the queue so they are never dropped
+        self.prerolled = deque(frames)
+        self.on_prerolled = on_prerolled if frames else None
+        self.release = release or (lambda frame: None)
+        self.frames = deque()
+        self.accepted = len(self.prerolled)
+        self.written = 0
+        self.dropped = 0
+        self.closed = False
+        self._cond = Condition()
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def put(self, frame):
+        """Queue a frame, frames put after close() are ignored"""
+        with self._cond:
+            if self.closed:
+                self.release(frame)
+                return
+            if self.capacity is None:
+                self.capacity = max(int(self.max_bytes // frame.nbytes), 2)
+            if len(self.frames) >= self.capacity:
+                self.release(self.frames.popleft())
+                self.dropped += 1
+                self.accepted -= 1
+                sampled_log(self.filename, f"Storage is falling behind, {self.dropped} frames dropped from {self.filename}", logging.WARNING)
+            self.frames.append(frame)
+            self.accepted += 1
+            self._cond.notify()
+
+    def run(self):
+        timer = metrics.time(self.stage)
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.prerolled or self.frames or self.closed)
+                if not (self.prerolled or self.frames):
+                    return
+                prerolled = bool(self.prerolled)
+                frame = (self.prerolled or self.frames).popleft()
+            with timer:
+                self.writer.write(frame)
+            self.release(frame)
+            if prerolled and not self.prerolled and self.on_prerolled:
+                self.on_prerolled()
+            self.written += 1
+            if self.written == 1:
+                log.info(f"First frame written to {self.filename}")
+
+    @property
+    def h264(self):
+        return not needs_transcode(self.writer)
+
+    @property
+    def position(self):
+        """Number of frames written or waiting to be, i.e. the position of the next frame in the file"""
+        return self.accepted
+
+    def close(self):
+        """Write what's still queued and close the file, returns the number of frames written"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.writer.release()
+        return self.written
+
+    def stats(self):
+        return {"queued": len(self.prerolled) + len(self.frames), "written": self.written, "dropped": self.dropped}
@@ -0,0 +1,253 @@
+import cv2
+import os
+import sqlite3
+import logging
+
+from json import dump, dumps, loads
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from threading import Lock
+from datetime import datetime
+from config import recordings_dir, recordings_index_file, recordings_json_file
+
+log = logging.getLogger("CameraSystem")
+
+# Recordings are named {%Y-%m-%d_%H-%M-%S}.{RecordingsType.value}[.processing].mp4
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+def parse_filename(name):
+    """Return the (start datetime or None, recording type or None) encoded in a recording filename"""
+    parts = os.path.basename(name).split(".")
+    try:
+        started = datetime.strptime(parts[0], TIMESTAMP_FORMAT)
+    except ValueError:
+        started = None
+    rec_type = parts[1] if len(parts) > 2 and parts[1] != "processing" else None
+    return started, rec_type
+
+
+class RecordingsIndex:
+    """
+    Persistent SQLite index of recording metadata.
+
+    Rows are keyed by filename and remember the mtime and size the file had when it was probed,
+    so a recording is only opened again with OpenCV when it actually changed on disk.
+    """
+
+    def __init__(self, db_file, directory, json_file=None):
+        self.directory = directory
+        self.json_file = json_file
+        self._lock = Lock()
+        # Used from the request handlers, the recorder and the transcode workers
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS recordings (
+                    name TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    type TEXT,
+                    started TEXT,
+                    processing INTEGER NOT NULL DEFAULT 0,
+                    corrupt INTEGER NOT NULL DEFAULT 0,
+                    frames INTEGER NOT NULL DEFAULT 0,
+                    fps REAL NOT NULL DEFAULT 0,
+                    duration REAL NOT NULL DEFAULT 0,
+                    width INTEGER NOT NULL DEFAULT 0,
+                    height INTEGER NOT NULL DEFAULT 0,
+                    thumbnail TEXT
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS recordings_started ON recordings (started, name)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS recordings_type_started ON recordings (type, started, name)")
+
+    def probe(self, name):
+        """Read the metadata of a recording, thumbnails are created separately by the thumbnail service"""
+        video_path = os.path.join(self.directory, name)
+        thumbnail = os.path.join(self.directory, f"thumbnails/{name}.jpg")
+        started, rec_type = parse_filename(name)
+        stat = os.stat(video_path)
+        row = {
+            "name": name, "mtime": stat.st_mtime, "size": stat.st_size, "type": rec_type,
+            "started": started.isoformat() if started else "", "processing": int(".processing" in name),
+            "corrupt": 0, "frames": 0, "fps": 0, "duration": 0, "width": 0, "height": 0, "thumbnail": None,
+        }
+
+        # Still being written to, nothing useful can be read yet
+        if row["processing"]:
+            return row
+
+        if os.path.isfile(thumbnail):
+            row["thumbnail"] = os.path.basename(thumbnail)
+
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            log.warning(f"Unable to open recording {name}")
+            row["corrupt"] = 1
+            return row
+
+        row["frames"] = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        row["fps"] = cap.get(cv2.CAP_PROP_FPS)
+        row["duration"] = row["frames"] / row["fps"] if row["fps"] > 0 else 0
+        row["width"] = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        row["height"] = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        cap.release()
+        return row
+
+    def update(self, name, export=True):
+        """Index a recording, it is only probed if its mtime or size changed since the last time"""
+        name = os.path.basename(name)
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            return self.remove(name, export)
+
+        with self._lock:
+            known = self._db.execute("SELECT mtime, size FROM recordings WHERE name = ?", (name,)).fetchone()
+        if known and known["mtime"] == stat.st_mtime and known["size"] == stat.st_size:
+            return False
+
+        row = self.probe(name)
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO recordings ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                tuple(row.values())
+            )
+        export and self.export_json()
+        return True
+
+    def set_thumbnail(self, name, thumbnail):
+        with self._lock, self._db:
+            self._db.execute("UPDATE recordings SET thumbnail = ? WHERE name = ?", (thumbnail, os.path.basename(name)))
+
+    def remove(self, name, export=True):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM recordings WHERE name = ?", (os.path.basename(name),))
+        export and self.export_json()
+
+    def sync(self):
+        """Bring the index in line with the recordings directory, e.g. after files were changed while offline"""
+        on_disk = {
+            entry.name for entry in os.scandir(self.directory)
+            if entry.name.endswith(".mp4") and not entry.name.endswith(".tmp.mp4")
+        }
+        with self._lock:
+            indexed = {row["name"] for row in self._db.execute("SELECT name FROM recordings")}
+
+        for name in indexed - on_disk:
+            self.remove(name, export=False)
+        changed = 0
+        for name in on_disk:
+            try:
+                changed += self.update(name, export=False)
+            except Exception as e:
+                log.error(f"Failed to index {name}: {e}")
+
+        log.info(f"Recordings index synced, {changed} probed, {len(indexed - on_disk)} removed")
+        self.export_json()
+
+    def get(self, name):
+        with self._lock:
+            return self._db.execute("SELECT * FROM recordings WHERE name = ?", (name,)).fetchone()
+
+    def total_size(self):
+        """Bytes taken up by all recordings"""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM recordings").fetchone()[0]
+
+    def list(self, limit=None, offset=0):
+        """Rows of the index, newest first"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM recordings ORDER BY started DESC, name DESC LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset)
+            ).fetchall()
+
+    def query(self, limit=50, cursor=None, rec_type=None, since=None, until=None, newest_first=True):
+        """
+        One page of the index filtered by recording type and start time.
+        Returns the rows and an opaque cursor for the next page, None when this is the last page.
+        """
+        where, args = [], []
+        if rec_type:
+            where.append("type = ?")
+            args.append(rec_type)
+        if since:
+            where.append("started >= ?")
+            args.append(since.isoformat())
+        if until:
+            where.append("started < ?")
+            args.append(until.isoformat())
+        if cursor:
+            # Keyset pagination, continue right after the last row of the previous page
+            where.append(f"(started, name) {'<' if newest_first else '>'} (?, ?)")
+            args.extend(decode_cursor(cursor))
+
+        order = "DESC" if newest_first else "ASC"
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM recordings {'WHERE ' + ' AND '.join(where) if where else ''} "
+                f"ORDER BY started {order}, name {order} LIMIT ?",
+                (*args, limit + 1)
+            ).fetchall()
+
+        # One extra row was requested to know if there is a next page
+        if limit < 1 or len(rows) <= limit:
+            return rows[:max(limit, 0)], None
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1]["started"], rows[-1]["name"])
+
+    def export_json(self):
+        """Keep recordings.json as a static fallback for the dashboard when the backend is unreachable"""
+        if not self.json_file:
+            return
+        try:
+            with open(self.json_file, 'w', encoding='utf-8') as f:
+                dump([summary(row) for row in self.list()], f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            log.error(f"Failed to update recordings.json: {e}")
+
+
+def encode_cursor(started, name):
+    return urlsafe_b64encode(dumps([started, name]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Raises ValueError if the cursor was not produced by encode_cursor"""
+    try:
+        started, name = loads(urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    return str(started), str(name)
+
+
+def info(row):
+    """Index row in the format of /videos"""
+    if row["processing"]:
+        return {"filename": row["name"], "processing": True}
+    if row["corrupt"]:
+        return {"filename": row["name"], "corrupt": True}
+    return {
+        'filename': row["name"],
+        'thumbnail': row["thumbnail"],
+        'size': row["size"],
+        'duration': row["duration"],
+        'width': row["width"],
+        'height': row["height"],
+    }
+
+
+def summary(row):
+    """Index row in the format of /recordings/ and recordings.json"""
+    return {
+        "name": row["name"],
+        "url": f"/recordings/{row['name']}",
+        "date": row["name"].split("_")[0],
+        "size": f"{row['size'] // 1_000_000} MB",
+        "duration": f"{int(row['duration'])}s" if row["duration"] else "N/A",
+    }
+
+
+recordings_index = RecordingsIndex(recordings_index_file, recordings_dir, recordings_json_file)
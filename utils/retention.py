@@ -0,0 +1,62 @@
+import shutil
+import logging
+
+from datetime import datetime, timedelta
+from typing import Callable
+from options import options
+from config import recordings_dir
+from utils import delete_video
+from utils.recordings_index import recordings_index
+
+log = logging.getLogger("CameraSystem")
+
+
+def enforce_retention(busy: Callable[[str], bool] = lambda name: False):
+    """
+    Delete the oldest recordings until the retention limits are met:
+    options.retentiondays (max age), options.retentionmaxgb (max total size of the recordings)
+    and options.retentionminfreegb (min free disk space). A limit of 0 disables it.
+    Recordings still being written are never deleted, nor those `busy` returns True for,
+    e.g. while they are transcoded. Returns the names of the deleted recordings.
+    """
+    # An options.json saved by older versions, which stored zeros as None, may still have None here
+    max_age = options.retentiondays or 0
+    max_bytes = (options.retentionmaxgb or 0) * 1e9
+    min_free = (options.retentionminfreegb or 0) * 1e9
+    if not (max_age or max_bytes or min_free):
+        return []
+
+    deleted = []
+    try:
+        _delete_oldest(max_age, max_bytes, min_free, busy, deleted)
+    finally:
+        # recordings.json is rewritten once, not for every deleted recording
+        deleted and recordings_index.export_json()
+    return deleted
+
+
+def _delete_oldest(max_age, max_bytes, min_free, busy, deleted):
+    cutoff = max_age and (datetime.now() - timedelta(days=max_age)).isoformat()
+    total = recordings_index.total_size()
+    cursor = None
+
+    while True:
+        # Oldest first, so the first recording within all limits means every newer one is too
+        rows, cursor = recordings_index.query(100, cursor, newest_first=False)
+        for row in rows:
+            if row["processing"] or busy(row["name"]):
+                continue
+            too_old = cutoff and row["started"] and row["started"] < cutoff
+            too_big = max_bytes and total > max_bytes
+            too_full = min_free and shutil.disk_usage(recordings_dir).free < min_free
+            if not (too_old or too_big or too_full):
+                # Names that don't parse have no start time and sort first, they say nothing about the age of the rest
+                if not row["started"]:
+                    continue
+                return
+            delete_video(row["name"], export=False)
+            total -= row["size"]
+            deleted.append(row["name"])
+            log.info(f"Retention policy deleted {row['name']}")
+        if not cursor:
+            return
@@ -0,0 +1,209 @@
+import os
+import shutil
+import logging
+import subprocess
+
+from math import ceil
+from time import monotonic, sleep
+from threading import Lock
+from utils.recorder import FfmpegWriter, RecordingWriter, ffmpeg_binary
+
+log = logging.getLogger("CameraSystem")
+
+
+class Clip:
+    """
+    A recording made from the shared stream, the frames from `start` up to where it's closed.
+    Has the parts of the RecordingWriter interface the camera uses.
+    """
+    h264 = True
+
+    def __init__(self, encoder: "SharedEncoder", run, filename, start):
+        self.encoder = encoder
+        self.run = run
+        self.filename = filename
+        self.start = start
+        self.closed = False
+        # Frames the shared writer dropped while the clip was recording
+        self._dropped_from = run.writer.dropped
+        self._dropped_until = None
+
+    @property
+    def dropped(self):
+        until = self.run.writer.dropped if self._dropped_until is None else self._dropped_until
+        return until - self._dropped_from
+
+    def close(self):
+        """Cut the clip from the stream, returns the number of frames in it, 0 if it couldn't be cut"""
+        return self.encoder.close_clip(self)
+
+    def stats(self):
+        return {"start": self.start, "dropped": self.dropped}
+
+
+class EncoderRun:
+    """One run of the encoder, from the first recording that needs it until the last one stops"""
+
+    def __init__(self, directory, fps, gop):
+        self.directory = directory
+        self.fps = fps
+        self.gop = gop
+        self.writer: RecordingWriter = None
+        # Set once the encoder has exited, all chunks are complete then
+        self.stopped = False
+
+    def chunk(self, index):
+        return os.path.join(self.directory, f"{index:08d}.ts")
+
+    @property
+    def pattern(self):
+        return os.path.join(self.directory, "%08d.ts")
+
+
+class SharedEncoder:
+    """
+    One H.264 encoder shared by all recordings, however many types overlap.
+
+    While any recording is active, frames are encoded once into keyframe aligned MPEG-TS
+    chunks of `gop` frames: chunk k holds frames k * gop up to (k + 1) * gop, which makes
+    the chunk number the keyframe index. A recording only remembers the frame it started at
+    and is cut from the chunks by stream copy when it's closed, at keyframe boundaries, so it
+    can start up to a chunk early and end up to a chunk late. Chunks no recording needs anymore
+    are deleted, apart from the last `keep_frames` for the pre-roll of the next motion clip.
+    """
+
+    def __init__(self, directory, encoder, preset, max_bytes, chunk_seconds=2, release=None):
+        self.directory = directory
+        self.encoder = encoder
+        self.preset = preset
+        self.max_bytes = max_bytes
+        self.chunk_seconds = chunk_seconds
+        # Called with each frame once it's encoded or dropped, see RecordingWriter
+        self.release = release
+        self.keep_frames = 0
+        self.run: EncoderRun = None
+        self.clips: list[Clip] = []
+        self._runs = 0
+        self._lock = Lock()
+        # Left over from before a restart
+        shutil.rmtree(directory, ignore_errors=True)
+
+    @property
+    def running(self):
+        return self.run is not None
+
+    @property
+    def position(self):
+        return self.run.writer.position if self.run else 0
+
+    def put(self, frame):
+        """Queue a frame the caller retained, it's released right away if no recording is active"""
+        run = self.run
+        if run:
+            run.writer.put(frame)
+        elif self.release:
+            self.release(frame)
+
+    def open_clip(self, filename, fps, size, preroll=0, frames=(), on_prerolled=None):
+        """
+        Start a recording of the stream, starting the encoder if it isn't running, in which case it
+        starts with `frames` (the pre-roll). Otherwise the recording includes the last `preroll`
+        frames that were already encoded. `on_prerolled` is called once `frames` are encoded.
+        Returns None if the encoder can't be started.
+        """
+        with self._lock:
+            if not self.run:
+                self._runs += 1
+                gop = max(round(fps * self.chunk_seconds), 1)
+                run = EncoderRun(os.path.join(self.directory, str(self._runs)), fps, gop)
+                os.makedirs(run.directory, exist_ok=True)
+                output = [
+                    # A keyframe every gop frames, whatever the encoder would choose, and a chunk at each
+                    "-g", str(gop), "-force_key_frames", f"expr:gte(n,n_forced*{gop})",
+                    "-f", "segment", "-segment_time", str(gop / fps), "-segment_time_delta", "0.05",
+                    "-segment_format", "mpegts", "-reset_timestamps", "1", run.pattern,
+                ]
+                writer = FfmpegWriter(run.directory, fps, size, self.encoder, self.preset, output)
+                if not writer.isOpened():
+                    shutil.rmtree(run.directory, ignore_errors=True)
+                    return None
+                run.writer = RecordingWriter(run.directory, writer, self.max_bytes, frames, "write", on_prerolled, self.release)
+                self.run = run
+                log.info(f"Shared recording encoder started, {gop} frames per chunk")
+                start = 0
+            else:
+                start = max(self.run.writer.position - preroll, 0)
+            clip = Clip(self, self.run, filename, start)
+            self.clips.append(clip)
+        # Listed as processing until it's cut
+        open(filename, "wb").close()
+        return clip
+
+    def close_clip(self, clip: Clip):
+        with self._lock:
+            clip.closed = True
+            end = clip.run.writer.position
+            clip._dropped_until = clip.run.writer.dropped
+            if clip.run is self.run and not any(c.run is self.run and not c.closed for c in self.clips):
+                # The last recording, stop the encoder so the last chunk is completed
+                self.run = None
+                stopped = clip.run
+            else:
+                stopped = None
+        if stopped:
+            stopped.writer.close()
+            stopped.stopped = True
+        try:
+            return self.cut(clip, end)
+        finally:
+            with self._lock:
+                self.clips.remove(clip)
+            self.discard()
+
+    def cut(self, clip: Clip, end):
+        """Join the chunks holding the frames of the clip into its file, returns the number of frames"""
+        run = clip.run
+        first, last = clip.start // run.gop, ceil(end / run.gop)
+        # A chunk is complete once the next one is started, or the encoder is stopped
+        deadline = monotonic() + 2 * run.gop / run.fps + 5
+        while not run.stopped and not os.path.exists(run.chunk(last)) and monotonic() < deadline:
+            sleep(0.1)
+        complete = last if run.stopped or os.path.exists(run.chunk(last)) else last - 1
+        chunks = [run.chunk(i) for i in range(first, complete) if os.path.exists(run.chunk(i))]
+        if not chunks:
+            return 0
+
+        concat = clip.filename + ".txt"
+        with open(concat, "w") as f:
+            f.writelines(f"file '{chunk}'\n" for chunk in chunks)
+        try:
+            result = subprocess.run(
+                (ffmpeg_binary(), "-hide_banner", "-loglevel", "error", "-y", "-f", "concat", "-safe", "0",
+                 "-i", concat, "-c", "copy", "-movflags", "+faststart", "-f", "mp4", clip.filename),
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            )
+        finally:
+            os.remove(concat)
+        if result.returncode != 0:
+            log.error(f"Could not cut {clip.filename} from the shared stream: {result.stderr.decode(errors='replace').strip()}")
+            return 0
+        return min(end, complete * run.gop) - first * run.gop
+
+    def discard(self):
+        """Delete the chunks and runs no recording needs anymore"""
+        with self._lock:
+            runs = {clip.run for clip in self.clips} | ({self.run} if self.run else set())
+            for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+                if not any(os.path.basename(run.directory) == name for run in runs):
+                    shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            for run in runs:
+                starts = [clip.start for clip in self.clips if clip.run is run]
+                if run is self.run:
+                    starts.append(run.writer.position - self.keep_frames)
+                keep_from = max(min(starts), 0) // run.gop
+                for name in os.listdir(run.directory):
+                    if name.endswith(".ts") and int(name[:-3]) < keep_from:
+                        os.remove(os.path.join(run.directory, name))
+
+    def stats(self):
+        return {"running": int(self.running), "clips": len(self.clips), "position": self.position}
@@ -3,12 +3,32 @@ from datetime import datetime
 from flask_socketio import SocketIO
 from utils import notify_sock
 from utils.camera import cam_utils
+from utils.metrics import metrics
+from utils.events import EventQueue
 from utils import append_log, setup_autostart
-from config import app, log_file, testing_environment
+from utils.activitylog import activity_log
+from config import app, testing_environment, ASYNC_MODE, SOCKETIO_LOGGER
 from options import options
 
 # Initialise Flask-SocketIO (cors_allowed_origins='*' doesn't seem to want to behave)
-socketio = SocketIO(app, cors_allowed_origins='*', engineio_logger=True)
+socketio = SocketIO(app, async_mode=ASYNC_MODE, cors_allowed_origins='*', logger=SOCKETIO_LOGGER, engineio_logger=SOCKETIO_LOGGER)
+
+# Events that aren't replies to a client go through one emitter, so nobody waits for slow clients
+events = EventQueue(socketio.emit)
+socketio.start_background_task(events.run, socketio.sleep)
+
+def run_blocking(fn, *args):
+    """
+    Call `fn` on a real thread with eventlet/gevent and wait for it cooperatively, for handlers that
+    block on real threads, e.g. stop_recording joining the recording writers. Called directly otherwise
+    """
+    if socketio.async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args)
+    if socketio.async_mode == 'gevent':
+        from gevent import get_hub
+        return get_hub().threadpool.apply(fn, args)
+    return fn(*args)
 
 @socketio.on('connect')
 def connect():
@@ -26,12 +46,12 @@ def pause_feed():
 @socketio.on('poweroff')
 def handle_poweroff():
     # Stop recording if in progress
-    cam_utils.stop_recording()
+    run_blocking(cam_utils.stop_recording)
     
     # Log shutdown to activity logs if logging is enabled
     if options.logging:
         log_data = append_log("poweroff", "System shutdown", "System shutdown initiated by user")
-        socketio.emit("new-log", log_data)
+        events.emit("new-log", log_data)
         cam_utils.pause(False, "Camera is offline")
 
     # Finally, R.I.P.
@@ -41,7 +61,7 @@ def handle_poweroff():
 @socketio.on('reboot')
 def handle_reboot():
     # Stop recording if in progress
-    cam_utils.stop_recording()
+    run_blocking(cam_utils.stop_recording)
     
     try:
         # Setup systemd service
@@ -50,7 +70,7 @@ def handle_reboot():
         # Log reboot to activity logs if logging is enabled
         if options.logging:
             log_data = append_log("reboot", "System reboot", "System reboot initiated by user")
-            socketio.emit("new-log", log_data)
+            events.emit("new-log", log_data)
             cam_utils.pause(False, "Camera is offline")
 
         socketio.emit('inform', {"title": "Rebooting", "description": "See you in a bit 🫡"})
@@ -72,13 +92,13 @@ def handle_camera_option_change(key, value):
     if key == 'bulk':
         # 'bulk' option means the value is a dictionary of multiple options
         for k, v in value.items():
-            matched = cam_utils.match_option(k, v)
+            matched = run_blocking(cam_utils.match_option, k, v)
             if matched:
                 messages.append(matched)
                 not matched[3] and no_save.append(k)
     else:
         # Single option change
-        matched = cam_utils.match_option(key, value)
+        matched = run_blocking(cam_utils.match_option, key, value)
         if matched:
             messages.append(matched)
             not matched[3] and no_save.append(key)
@@ -88,13 +108,15 @@ def handle_camera_option_change(key, value):
         return
 
     if key == 'bulk':
-        # Update each option in the dictionary with corresponding value
-        for k, v in value.items():
-            if k not in no_save:
-                errored = options.update_option(k, v)
-                if errored:
-                    errors.append((f"Error updating {k}", errored))
-                    continue # Not breaking as there might be other options that can be updated
+        # Update each option in the dictionary with corresponding value,
+        # as one batch so options.json is written once
+        with options.batch():
+            for k, v in value.items():
+                if k not in no_save:
+                    errored = options.update_option(k, v)
+                    if errored:
+                        errors.append((f"Error updating {k}", errored))
+                        continue # Not breaking as there might be other options that can be updated
     elif key not in no_save:
         errored = options.update_option(key, value)
         if errored:
@@ -106,20 +128,25 @@ def handle_camera_option_change(key, value):
         # Should also make a last log that logs are disabled if this event disables logging
         if options.logging or key == 'logging':
             log_data = append_log(key, title, description)
-            socketio.emit("new-log", log_data)
+            events.emit("new-log", log_data)
 
         if key not in ('recording247', 'motiondetection'):
             # Recording and motion detection are logged separately
             # in cam_utils.start_recording()
-            notify_sock(title, key, socketio)
+            notify_sock(title, key, events)
 
 @socketio.on('clear-logs')
 def handle_clear_logs():
-    with open(log_file, 'w'):
-        socketio.emit('new-log', None)
-        notify_sock("Logs cleared", "logging", socketio)
+    activity_log.clear()
+    events.emit('new-log', None)
+    notify_sock("Logs cleared", "logging", events)
 
 @socketio.on('yo, you alive?')
 def handle_alive():
     # Confirm that the server is alive and sent time to sync with client
-    socketio.emit('alive and not kicking because I have not legs', str(datetime.now()))
\ No newline at end of file
+    socketio.emit('alive and not kicking because I have not legs', str(datetime.now()))
+
+@socketio.on('stats')
+def handle_stats():
+    # Pipeline stage timings, frame rate and buffer usage, the same data as /metrics
+    socketio.emit('stats', metrics.snapshot())
\ No newline at end of file
@@ -0,0 +1,175 @@
+import os
+import cv2
+
+from time import monotonic
+from threading import Lock, Condition, Thread
+from utils.framebus import FrameBus
+from utils.metrics import metrics
+from utils.thumbnails import resize_to_width
+
+MJPEG_MIMETYPE = 'multipart/x-mixed-replace; boundary=frame'
+
+
+class MjpegBroadcaster:
+    """
+    JPEG encodes each published frame at most once and hands the very same bytes
+    (multipart header included) to every connected /feed client.
+
+    Clients always get the newest frame, so a slow client just skips frames
+    instead of building up a backlog.
+    """
+
+    def __init__(self, frames: FrameBus, quality: int = None):
+        self.frames = frames
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality else []
+        self._lock = Lock()
+        self._seq = 0
+        self._part: bytes = None
+
+    def encode(self, published):
+        """
+        Return (seq, multipart bytes) for a (seq, frame, timestamp) tuple from the frame bus.
+        If a newer frame has already been encoded, that one is returned instead.
+        """
+        seq, frame, _ = published
+        with self._lock:
+            if seq > self._seq:
+                with metrics.time("jpeg"):
+                    ret, buffer = cv2.imencode('.jpg', frame, self.params)
+                if not ret:
+                    return self._seq, self._part
+                self._seq = seq
+                self._part = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n'
+            return self._seq, self._part
+
+    def next_part(self, after=0, timeout=1.0, sleep=None):
+        """
+        Wait for a frame newer than `after` and return its (seq, multipart bytes), or None on timeout.
+        Green threads pass their cooperative `sleep`, see FrameBus.wait
+        """
+        published = self.frames.wait(after, timeout, sleep=sleep)
+        if not published:
+            return None
+        try:
+            return self.encode(published)
+        finally:
+            self.frames.release(published[1])
+
+
+def encode_jpeg(frame, params):
+    """Function of the JPEG ProcessStage, runs in a worker process"""
+    ret, buffer = cv2.imencode('.jpg', frame, params)
+    return buffer.tobytes() if ret else None
+
+
+class PooledMjpegBroadcaster(MjpegBroadcaster):
+    """
+    MjpegBroadcaster encoding in the worker processes of a ProcessStage (PIPELINE_MODE processes).
+
+    While anyone is watching, a feeder thread hands every published frame to the stage without
+    waiting for the result, so the workers encode consecutive frames at the same time. Frames are
+    skipped while all workers are busy. Results can arrive out of order, older ones are ignored.
+    """
+
+    # Stop feeding the workers this long after the last client asked for a frame
+    IDLE_TIMEOUT = 2.0
+
+    def __init__(self, frames: FrameBus, stage, quality: int = None):
+        super().__init__(frames, quality)
+        self.stage = stage
+        self._ready = Condition(self._lock)
+        self._wanted = 0.0
+        self._thread: Thread = None
+
+    def encode(self, published):
+        """Return the newest encoded (seq, multipart bytes), the workers encode the frames"""
+        with self._lock:
+            return self._seq, self._part
+
+    def next_part(self, after=0, timeout=1.0, sleep=None):
+        with self._lock:
+            self._wanted = monotonic()
+            # Clients connecting at the same time must not start a feeder each
+            if not self._thread or not self._thread.is_alive():
+                self._thread = Thread(target=self.run, name="jpeg-feeder", daemon=True)
+                self._thread.start()
+        if sleep:
+            deadline = monotonic() + timeout
+            while self._seq <= after and monotonic() < deadline:
+                sleep(self.frames.poll_interval)
+        else:
+            with self._ready:
+                self._ready.wait_for(lambda: self._seq > after, timeout)
+        with self._lock:
+            return (self._seq, self._part) if self._seq > after else None
+
+    def run(self):
+        seq = 0
+        while monotonic() - self._wanted < self.IDLE_TIMEOUT:
+            published = self.frames.wait(seq)
+            if not published:
+                continue
+            seq, frame, _ = published
+            submitted = monotonic()
+            try:
+                # Copied into the shared memory of the stage, the frame isn't needed afterwards
+                self.stage.submit(frame, (self.params,), lambda jpg, seq=seq, submitted=submitted: self._encoded(seq, jpg, submitted))
+            finally:
+                self.frames.release(frame)
+
+    def _encoded(self, seq, jpg, submitted):
+        metrics.histogram("jpeg").observe(monotonic() - submitted)
+        if jpg is None:
+            return
+        with self._ready:
+            if seq > self._seq:
+                self._seq = seq
+                self._part = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpg + b'\r\n'
+                self._ready.notify_all()
+
+
+class SnapshotCache:
+    """
+    Still images of the newest published frame, for /api/snapshot.jpg.
+
+    Each size and quality is encoded at most once per frame and kept until the next frame
+    is published, so clients polling for a snapshot cost next to nothing.
+    """
+
+    def __init__(self, frames: FrameBus, max_variants=16):
+        self.frames = frames
+        self.max_variants = max_variants
+        # Differs per process, part of the ETags as frame numbers start over after a restart
+        self.nonce = os.urandom(4).hex()
+        self._lock = Lock()
+        self._seq = 0
+        self._variants: dict[tuple, bytes] = {}
+
+    def get(self, width: int = None, quality: int = None):
+        """(seq, JPEG bytes) of the newest frame, or None if no frame was published yet"""
+        published = self.frames.latest()
+        if not published:
+            return None
+        seq, frame, _ = published
+        try:
+            return self.encode(seq, frame, width, quality)
+        finally:
+            self.frames.release(frame)
+
+    def encode(self, seq, frame, width, quality):
+        key = width, quality
+        with self._lock:
+            if seq != self._seq:
+                self._seq = seq
+                self._variants.clear()
+            jpg = self._variants.get(key)
+            if jpg is None:
+                image = resize_to_width(frame, width) if width else frame
+                with metrics.time("snapshot"):
+                    ret, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality] if quality else [])
+                if not ret:
+                    return None
+                jpg = buffer.tobytes()
+                if len(self._variants) < self.max_variants:
+                    self._variants[key] = jpg
+            return seq, jpg
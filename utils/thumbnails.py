@@ -0,0 +1,124 @@
+import cv2
+import os
+import logging
+import numpy as np
+
+from queue import Queue
+from threading import Thread
+from typing import Callable
+from config import recordings_dir, THUMBNAIL_SIZES, THUMBNAIL_SPRITE_FRAMES
+
+log = logging.getLogger("CameraSystem")
+
+
+class ThumbnailService:
+    """
+    Creates the thumbnails of finished recordings on a background thread,
+    so listing recordings never has to decode any video.
+
+    For every recording {name}.mp4 it writes thumbnails/{name}.{size}.jpg for each configured size,
+    thumbnails/{name}.jpg (the first size, used by the dashboard) and optionally
+    thumbnails/{name}.sprite.jpg, a strip of evenly spaced frames for hover previews.
+    `on_ready(filename, thumbnail)` is called once the thumbnails of a recording exist.
+    """
+
+    def __init__(self, directory, sizes=None, sprite_frames=0):
+        self.directory = directory
+        self.thumbnails_dir = os.path.join(directory, "thumbnails")
+        # Width in pixels of each size, the first one is the default thumbnail
+        self.sizes = sizes or {"medium": 320, "small": 160}
+        self.sprite_frames = sprite_frames
+        self.on_ready: Callable = None
+        self._queue = Queue()
+        # Names queued or being processed
+        self._busy = set()
+        os.makedirs(self.thumbnails_dir, exist_ok=True)
+
+    def start(self):
+        Thread(target=self._work, name="thumbnails", daemon=True).start()
+
+    def path(self, name, size=None):
+        name = os.path.basename(name)
+        return os.path.join(self.thumbnails_dir, f"{name}.{size}.jpg" if size else f"{name}.jpg")
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def submit(self, filename):
+        self._busy.add(os.path.basename(filename))
+        self._queue.put(os.path.basename(filename))
+
+    def busy(self, name):
+        """Whether thumbnails of the recording `name` are queued or being generated"""
+        return name in self._busy
+
+    def remove(self, name):
+        for size in (None, "sprite", *self.sizes):
+            try:
+                os.remove(self.path(name, size))
+            except FileNotFoundError:
+                pass
+
+    def _work(self):
+        while True:
+            name = self._queue.get()
+            try:
+                self.generate(name)
+                self.on_ready and self.on_ready(name, os.path.basename(self.path(name)))
+            except Exception as e:
+                log.error(f"Failed to create thumbnails for {name}: {e}")
+            finally:
+                self._busy.discard(name)
+
+    def generate(self, name):
+        cap = cv2.VideoCapture(os.path.join(self.directory, name))
+        if not cap.isOpened():
+            raise IOError(f"Unable to open recording {name}")
+
+        try:
+            frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+            # Capture a frame around the middle of the video
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count // 2)
+            ret, frame = cap.read()
+            if not ret:
+                raise IOError(f"Unable to read a frame from {name}")
+            for i, (size, width) in enumerate(self.sizes.items()):
+                thumbnail = resize_to_width(frame, width)
+                write_jpg(self.path(name, size), thumbnail)
+                # The first size is also available under the name the dashboard already uses
+                i == 0 and write_jpg(self.path(name), thumbnail)
+
+            if self.sprite_frames > 0 and frame_count > 0:
+                self.generate_sprite(cap, name, frame_count)
+        finally:
+            cap.release()
+
+    def generate_sprite(self, cap, name, frame_count):
+        # Evenly spaced frames side by side at the smallest size
+        width = min(self.sizes.values())
+        tiles = []
+        for i in range(self.sprite_frames):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int((i + 0.5) * frame_count / self.sprite_frames))
+            ret, frame = cap.read()
+            if ret:
+                tiles.append(resize_to_width(frame, width))
+        if tiles:
+            write_jpg(self.path(name, "sprite"), np.hstack(tiles))
+
+
+def resize_to_width(frame, width):
+    height, frame_width = frame.shape[:2]
+    if frame_width <= width:
+        return frame
+    return cv2.resize(frame, (width, round(height * width / frame_width)), interpolation=cv2.INTER_AREA)
+
+
+def write_jpg(path, image):
+    # Written under a temporary name first so a half written thumbnail is never served
+    temp_path = path + ".tmp.jpg"
+    cv2.imwrite(temp_path, image)
+    os.replace(temp_path, path)
+
+
+thumbnails = ThumbnailService(recordings_dir, THUMBNAIL_SIZES, THUMBNAIL_SPRITE_FRAMES)
@@ -0,0 +1,144 @@
+import os
+import logging
+
+from json import dump, load
+from threading import Thread, Condition, get_native_id
+from typing import Callable
+
+log = logging.getLogger("CameraSystem")
+
+
+class TranscodeQueue:
+    """
+    Background queue converting finished recordings to browser playable H.264.
+
+    Pending jobs are stored in `queue_file` so that a restart resumes them,
+    and the workers run at a lower priority so live capture keeps its frame rate.
+    `on_status(filename, status)` is called with "queued", "transcoding", "ready", "failed"
+    or "cancelled" when the recording was deleted while it was transcoded.
+    """
+
+    def __init__(self, queue_file, workers=1, threads=2, niceness=10, maxsize=32):
+        self.queue_file = queue_file
+        self.workers = workers
+        self.threads = threads
+        self.niceness = niceness
+        self.maxsize = maxsize
+        self.on_status: Callable = None
+        self._pending = []
+        self._active = set()
+        # Active jobs whose recording was deleted, their result is thrown away
+        self._cancelled = set()
+        self._cond = Condition()
+        self._threads = []
+
+    def start(self):
+        """Load unfinished jobs from the last run and start the workers"""
+        try:
+            with open(self.queue_file) as f:
+                resumed = [name for name in load(f) if os.path.isfile(name)]
+        except Exception:
+            # No queue file yet or it's corrupt, nothing to resume
+            resumed = []
+        with self._cond:
+            # Recordings submitted before the workers started are kept behind the resumed ones
+            self._pending = resumed + [name for name in self._pending if name not in resumed]
+
+        if self._pending:
+            log.info(f"Resuming {len(self._pending)} unfinished transcode job(s)")
+
+        for i in range(max(self.workers, 1)):
+            thread = Thread(target=self._work, name=f"transcode-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, filename):
+        """Queue a recording for transcoding, returns False if the queue is full"""
+        with self._cond:
+            if filename in self._pending or filename in self._active:
+                return True
+            if len(self._pending) >= self.maxsize:
+                log.error(f"Transcode queue full, {filename} is kept in its original codec")
+                return False
+            self._pending.append(filename)
+            self._save()
+            self._cond.notify()
+        self._status(filename, "queued")
+        return True
+
+    def busy(self, name):
+        """Whether the recording `name` (a file name without directory) is queued or being transcoded"""
+        with self._cond:
+            return any(os.path.basename(filename) == name for filename in (*self._pending, *self._active))
+
+    def cancel(self, name):
+        """Drop the jobs of the recording `name` (a file name without directory), e.g. because it's deleted"""
+        with self._cond:
+            self._pending = [filename for filename in self._pending if os.path.basename(filename) != name]
+            self._cancelled.update(filename for filename in self._active if os.path.basename(filename) == name)
+            self._save()
+
+    def _save(self):
+        # Active jobs are saved as well, they start over if interrupted
+        with open(self.queue_file, "w") as f:
+            dump([*self._active, *self._pending], f)
+
+    def _status(self, filename, status):
+        # A failing callback must not end the worker or fail the transcode
+        try:
+            self.on_status and self.on_status(filename, status)
+        except Exception as e:
+            log.error(f"Error reporting transcode status of {filename}: {e}")
+
+    def _work(self):
+        try:
+            # Lower the priority of this thread only, ffmpeg spawned from here inherits it
+            os.setpriority(os.PRIO_PROCESS, get_native_id(), self.niceness)
+        except (AttributeError, OSError) as e:
+            log.warning(f"Could not lower transcode worker priority: {e}")
+
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                filename = self._pending.pop(0)
+                self._active.add(filename)
+
+            try:
+                self._status(filename, "transcoding")
+                self._status(filename, "ready" if self.transcode(filename) else "cancelled")
+            except Exception as e:
+                log.error(f"Failed to transcode {filename}: {e}")
+                self._status(filename, "failed")
+            finally:
+                with self._cond:
+                    self._active.discard(filename)
+                    self._cancelled.discard(filename)
+                    self._save()
+
+    def transcode(self, filename):
+        """Convert `filename` in place, returns False if the job was cancelled in the meantime"""
+        import moviepy.editor as moviepy
+
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(filename)
+
+        temp_name = filename + ".tmp.mp4"
+        # Left over from an interrupted run
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+        clip = moviepy.VideoFileClip(filename)
+        try:
+            clip.write_videofile(temp_name, codec='libx264', threads=self.threads, preset='ultrafast', logger=None)
+        finally:
+            clip.close()
+        with self._cond:
+            # Deleted while it was transcoded, moving the result over it would bring the recording back
+            wanted = filename not in self._cancelled
+            wanted and os.replace(temp_name, filename)
+        if not wanted:
+            os.remove(temp_name)
+            log.info(f"Transcoding {filename} cancelled, the recording was deleted")
+            return False
+        log.info(f"Transcoded {filename}")
+        return True